@@ -1,7 +1,7 @@
 from fastapi import FastAPI, Request, HTTPException, UploadFile, File, Form
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi.responses import ORJSONResponse, FileResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
-from models import Patient
+from models import Patient, PatientBatch
 from girder_client import (
     get_or_create_folder,
     set_metadata,
@@ -12,12 +12,21 @@ from girder_client import (
     GirderError
 )
 from database import Database
+from anyio import CapacityLimiter
+from anyio.to_thread import run_sync
+from storage import shard_path, store_upload, open_stored_file
+import asyncio
+import atexit
+import functools
 import logging
+import logging.handlers
+import math
+import orjson
 import os
+import queue
 from pathlib import Path
-from typing import List
-import aiofiles
-import sqlite3
+from typing import Dict, Iterator, List, Optional, Tuple
+import time
 
 # Configure logging
 logging.basicConfig(
@@ -26,10 +35,29 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+
+def _log_through_queue():
+    """
+    Move the root handlers behind a queue so request handlers never block on log I/O.
+    
+    Records are formatted by the caller and written by a background thread.
+    """
+    root = logging.getLogger()
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, *root.handlers, respect_handler_level=True)
+    root.handlers = [logging.handlers.QueueHandler(log_queue)]
+    listener.start()
+    # Write out queued records before the process exits
+    atexit.register(listener.stop)
+
+
+_log_through_queue()
+
 app = FastAPI(
     title="REDCap to Girder Sync",
     description="Webhook endpoint to sync REDCap patient data to Girder",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse
 )
 
 # Root folder ID where all CHU folders will be created
@@ -42,6 +70,173 @@ db = Database()
 UPLOADS_DIR = Path("uploads")
 UPLOADS_DIR.mkdir(exist_ok=True)
 
+# Maximum number of files uploaded to Girder at the same time per request
+UPLOAD_CONCURRENCY = int(os.getenv("UPLOAD_CONCURRENCY", "4"))
+
+# Blocking work runs in worker threads; each resource gets its own limit so
+# that a burst of one kind of work can't starve the others
+DB_THREADS = int(os.getenv("DB_THREADS", "4"))
+FILE_IO_THREADS = int(os.getenv("FILE_IO_THREADS", "8"))
+GIRDER_THREADS = int(os.getenv("GIRDER_THREADS", "16"))
+
+# Limiters are created on startup since anyio needs a running event loop;
+# None falls back to anyio's default limiter
+DB_LIMITER: Optional[CapacityLimiter] = None
+FILE_IO_LIMITER: Optional[CapacityLimiter] = None
+GIRDER_LIMITER: Optional[CapacityLimiter] = None
+
+# Maximum number of patients synced to Girder at the same time per batch webhook
+WEBHOOK_BATCH_CONCURRENCY = int(os.getenv("WEBHOOK_BATCH_CONCURRENCY", "16"))
+
+# Seconds a successful Girder health probe is reused by /health
+HEALTH_CACHE_TTL = float(os.getenv("HEALTH_CACHE_TTL", "5"))
+_health_cache = {"checked_at": -math.inf}
+
+
+def _upload_stored_file(file_info: Dict, folder_id: str) -> Dict:
+    """Stream a stored upload to Girder (blocking, run in a worker thread)"""
+    with open_stored_file(file_info) as f:
+        return upload_file(f, folder_id, file_info['filename'], size=file_info['file_size'])
+
+
+async def _store_document_upload(document_type_id: int, file: UploadFile) -> Tuple[int, int]:
+    """
+    Append an upload to its document type's shard on local disk and record it.
+    
+    Returns:
+        Tuple of (file_id, file_size)
+    """
+    # Get document type info
+    doc_type = await run_sync(db.get_document_type, document_type_id, limiter=DB_LIMITER)
+    if not doc_type:
+        raise HTTPException(status_code=404, detail="Document type not found")
+    
+    # Append file to the document type's shard
+    mime_type = file.content_type or "application/octet-stream"
+    shard = shard_path(UPLOADS_DIR, doc_type['center_code'], doc_type['patient_id'],
+                       doc_type['visit_code'], doc_type['document_code'])
+    stored = await run_sync(
+        functools.partial(store_upload, shard, file.filename, file.file, mime_type, size=file.size),
+        limiter=FILE_IO_LIMITER
+    )
+    
+    # Save to database
+    file_id = await run_sync(
+        functools.partial(db.create_file, document_type_id, file.filename, str(shard),
+                          mime_type=mime_type, **stored),
+        limiter=DB_LIMITER
+    )
+    return file_id, stored['file_size']
+
+
+# ============================================================================
+# Girder Folder Resolution
+# ============================================================================
+
+# CHU folder IDs by center code; center folders are effectively permanent
+_chu_folder_ids: Dict[str, str] = {}
+
+# Patient folder IDs by (CHU folder ID, patient ID) -> (expires_at, folder ID).
+# IDs recorded in the database are trusted until Girder rejects them; IDs only
+# resolved from Girder expire after PATIENT_FOLDER_CACHE_TTL.
+PATIENT_FOLDER_CACHE_TTL = 300  # seconds
+_patient_folder_ids: Dict[Tuple[str, str], Tuple[float, str]] = {}
+
+
+def _preload_folder_cache(structure: List[Dict]):
+    """Seed the folder caches from Girder folder IDs recorded in the database"""
+    for center in structure:
+        chu_folder_id = center.get('girder_folder_id')
+        if not chu_folder_id:
+            continue
+        _chu_folder_ids.setdefault(center['code'], chu_folder_id)
+        for patient in center.get('patients', []):
+            if patient.get('girder_folder_id'):
+                _patient_folder_ids.setdefault(
+                    (chu_folder_id, patient['patient_id']),
+                    (math.inf, patient['girder_folder_id'])
+                )
+
+
+def _get_or_create_public_folder(name: str, parent_id: str, kind: str) -> str:
+    """Get or create a folder, make sure it is public, and return its ID"""
+    folder = get_or_create_folder(name, parent_id, public=True)
+    # Ensure folder is accessible
+    try:
+        set_folder_access(folder["_id"], public=True)
+    except GirderError:
+        # If setting access fails, continue anyway (folder might already be accessible)
+        logger.warning(f"Could not set access for {kind} folder, continuing...")
+    return folder["_id"]
+
+
+def _resolve_chu_folder(center_code: str) -> str:
+    """Get or create the CHU folder for a center, reusing the cached ID when known"""
+    folder_id = _chu_folder_ids.get(center_code)
+    if folder_id is None:
+        folder_id = _get_or_create_public_folder(f"CHU_{center_code}", ROOT_FOLDER_ID, "CHU")
+        _chu_folder_ids[center_code] = folder_id
+        db.set_center_folder_id(center_code, folder_id)
+    return folder_id
+
+
+def _resolve_patient_folder(center_code: str, patient_id: str) -> Tuple[str, str]:
+    """
+    Get or create a patient folder under its CHU folder.
+    
+    Resolved IDs are cached for PATIENT_FOLDER_CACHE_TTL seconds. If the lookup
+    fails, the cached CHU folder ID may be stale (e.g. deleted in Girder), so it
+    is dropped and the lookup is retried once.
+    
+    Returns:
+        Tuple of (chu_folder_id, patient_folder_id)
+    """
+    chu_folder_id = _resolve_chu_folder(center_code)
+    cached = _patient_folder_ids.get((chu_folder_id, patient_id))
+    if cached and cached[0] > time.monotonic():
+        return chu_folder_id, cached[1]
+    
+    try:
+        patient_folder_id = _get_or_create_public_folder(patient_id, chu_folder_id, "patient")
+    except GirderError:
+        _chu_folder_ids.pop(center_code, None)
+        chu_folder_id = _resolve_chu_folder(center_code)
+        patient_folder_id = _get_or_create_public_folder(patient_id, chu_folder_id, "patient")
+    
+    if db.set_patient_folder_id(center_code, patient_id, patient_folder_id):
+        expires_at = math.inf
+    else:
+        expires_at = time.monotonic() + PATIENT_FOLDER_CACHE_TTL
+    _patient_folder_ids[(chu_folder_id, patient_id)] = (expires_at, patient_folder_id)
+    return chu_folder_id, patient_folder_id
+
+
+def _forget_patient_folder(chu_folder_id: str, patient_id: str):
+    """Drop a cached patient folder ID after Girder rejected it"""
+    _patient_folder_ids.pop((chu_folder_id, patient_id), None)
+
+
+@app.on_event("startup")
+async def create_thread_limiters():
+    """Create the per-resource worker thread limiters"""
+    global DB_LIMITER, FILE_IO_LIMITER, GIRDER_LIMITER
+    DB_LIMITER = CapacityLimiter(DB_THREADS)
+    FILE_IO_LIMITER = CapacityLimiter(FILE_IO_THREADS)
+    GIRDER_LIMITER = CapacityLimiter(GIRDER_THREADS)
+
+
+@app.on_event("startup")
+async def preload_folder_cache():
+    """Load known CHU/patient folder IDs so the first webhooks skip Girder lookups"""
+    structure = await run_sync(db.get_full_structure, limiter=DB_LIMITER)
+    _preload_folder_cache(structure)
+
+
+@app.on_event("shutdown")
+def close_database():
+    """Close pooled SQLite connections (running PRAGMA optimize on the writer)"""
+    db.close()
+
 
 @app.get("/")
 async def root():
@@ -52,6 +247,7 @@ async def root():
         "version": "1.0.0",
         "endpoints": {
             "webhook": "/redcap/webhook",
+            "webhook_batch": "/redcap/webhook/batch",
             "file_upload": "/redcap/upload",
             "health": "/health",
             "mock_interface": "/mock-redcap",
@@ -87,20 +283,15 @@ async def redcap_webhook(patient: Patient, request: Request):
         JSON response with status and folder information
     """
     try:
-        logger.info(f"Received webhook for patient: {patient.patient_id} from center: {patient.center_code}")
+        logger.debug("Received webhook for patient: %s from center: %s", patient.patient_id, patient.center_code)
         
         # Step 1: Get or create CHU center folder
         chu_folder_name = f"CHU_{patient.center_code}"
-        logger.info(f"Looking for CHU folder: {chu_folder_name}")
+        logger.debug("Looking for CHU folder: %s", chu_folder_name)
         
         try:
-            chu_folder = get_or_create_folder(chu_folder_name, ROOT_FOLDER_ID, public=True)
-            # Ensure folder is accessible
-            try:
-                set_folder_access(chu_folder["_id"], public=True)
-            except GirderError:
-                logger.warning(f"Could not set access for CHU folder, continuing...")
-            logger.info(f"CHU folder '{chu_folder_name}' ready with ID: {chu_folder['_id']}")
+            chu_folder_id = await run_sync(_resolve_chu_folder, patient.center_code, limiter=GIRDER_LIMITER)
+            logger.debug("CHU folder '%s' ready with ID: %s", chu_folder_name, chu_folder_id)
         except GirderError as e:
             logger.error(f"Failed to get/create CHU folder: {str(e)}")
             raise HTTPException(
@@ -109,17 +300,13 @@ async def redcap_webhook(patient: Patient, request: Request):
             )
         
         # Step 2: Get or create patient folder within CHU folder
-        logger.info(f"Looking for patient folder: {patient.patient_id}")
+        logger.debug("Looking for patient folder: %s", patient.patient_id)
         
         try:
-            patient_folder = get_or_create_folder(patient.patient_id, chu_folder["_id"], public=True)
-            # Ensure folder is accessible
-            try:
-                set_folder_access(patient_folder["_id"], public=True)
-            except GirderError:
-                # If setting access fails, continue anyway (folder might already be accessible)
-                logger.warning(f"Could not set access for patient folder, continuing...")
-            logger.info(f"Patient folder '{patient.patient_id}' ready with ID: {patient_folder['_id']}")
+            chu_folder_id, patient_folder_id = await run_sync(
+                _resolve_patient_folder, patient.center_code, patient.patient_id, limiter=GIRDER_LIMITER
+            )
+            logger.debug("Patient folder '%s' ready with ID: %s", patient.patient_id, patient_folder_id)
         except GirderError as e:
             logger.error(f"Failed to get/create patient folder: {str(e)}")
             raise HTTPException(
@@ -128,36 +315,37 @@ async def redcap_webhook(patient: Patient, request: Request):
             )
         
         # Step 3: Set patient metadata
-        patient_data = patient.dict()
+        patient_data = patient.model_dump()
         try:
-            set_metadata(patient_folder["_id"], patient_data)
-            logger.info(f"Successfully synced patient {patient.patient_id} to Girder")
+            await run_sync(set_metadata, patient_folder_id, patient_data, limiter=GIRDER_LIMITER)
+            logger.info(
+                "Synced patient %s to Girder", patient.patient_id,
+                extra={"center_code": patient.center_code, "patient_folder_id": patient_folder_id}
+            )
         except GirderError as e:
+            _forget_patient_folder(chu_folder_id, patient.patient_id)
             logger.error(f"Failed to set metadata: {str(e)}")
             raise HTTPException(
                 status_code=500,
                 detail=f"Failed to set patient metadata: {str(e)}"
             )
         
-        return JSONResponse(
-            status_code=200,
-            content={
-                "status": "synced",
-                "message": f"Patient {patient.patient_id} successfully synced to Girder",
-                "folder_structure": {
-                    "root": ROOT_FOLDER_ID,
-                    "chu_folder": {
-                        "name": chu_folder_name,
-                        "id": chu_folder["_id"]
-                    },
-                    "patient_folder": {
-                        "name": patient.patient_id,
-                        "id": patient_folder["_id"]
-                    }
+        return {
+            "status": "synced",
+            "message": f"Patient {patient.patient_id} successfully synced to Girder",
+            "folder_structure": {
+                "root": ROOT_FOLDER_ID,
+                "chu_folder": {
+                    "name": chu_folder_name,
+                    "id": chu_folder_id
                 },
-                "patient_data": patient_data
-            }
-        )
+                "patient_folder": {
+                    "name": patient.patient_id,
+                    "id": patient_folder_id
+                }
+            },
+            "patient_data": patient_data
+        }
         
     except HTTPException:
         # Re-raise HTTP exceptions
@@ -170,6 +358,99 @@ async def redcap_webhook(patient: Patient, request: Request):
         )
 
 
+def _sync_patient(patient: Patient) -> Dict:
+    """Get or create a patient's folder and set its metadata (blocking, run in a worker thread)"""
+    chu_folder_id, patient_folder_id = _resolve_patient_folder(patient.center_code, patient.patient_id)
+    try:
+        set_metadata(patient_folder_id, patient.model_dump())
+    except GirderError:
+        _forget_patient_folder(chu_folder_id, patient.patient_id)
+        raise
+    return {
+        "center_code": patient.center_code,
+        "patient_id": patient.patient_id,
+        "chu_folder_id": chu_folder_id,
+        "patient_folder_id": patient_folder_id
+    }
+
+
+@app.post("/redcap/webhook/batch")
+async def redcap_webhook_batch(batch: PatientBatch):
+    """
+    Batch variant of /redcap/webhook for syncing many patients at once.
+    
+    Each distinct CHU folder is resolved once for the whole batch, then the
+    patients are synced concurrently. A failure only affects its own patient.
+    A patient listed more than once is synced once, with its last payload.
+    
+    Args:
+        batch: Patients to sync
+        
+    Returns:
+        JSON response with the synced and failed patients
+    """
+    try:
+        logger.debug("Received batch webhook for %d patient(s)", len(batch.patients))
+        
+        # Syncing the same patient twice at once could create its folder twice
+        patients = list({(p.center_code, p.patient_id): p for p in batch.patients}.values())
+        
+        # Step 1: Get or create each CHU center folder once
+        center_codes = list(dict.fromkeys(p.center_code for p in patients))
+        chu_results = await asyncio.gather(
+            *[run_sync(_resolve_chu_folder, code, limiter=GIRDER_LIMITER) for code in center_codes],
+            return_exceptions=True
+        )
+        chu_errors = {
+            code: result for code, result in zip(center_codes, chu_results)
+            if isinstance(result, Exception)
+        }
+        
+        # Step 2: Sync patients concurrently
+        semaphore = asyncio.Semaphore(WEBHOOK_BATCH_CONCURRENCY)
+        
+        async def sync_one(patient: Patient) -> Dict:
+            if patient.center_code in chu_errors:
+                raise GirderError(f"Failed to access CHU folder: {chu_errors[patient.center_code]}")
+            async with semaphore:
+                return await run_sync(_sync_patient, patient, limiter=GIRDER_LIMITER)
+        
+        results = await asyncio.gather(
+            *[sync_one(patient) for patient in patients],
+            return_exceptions=True
+        )
+        
+        synced_patients = []
+        failed_patients = []
+        for patient, result in zip(patients, results):
+            if isinstance(result, Exception):
+                logger.error(f"Failed to sync patient {patient.patient_id}: {str(result)}")
+                failed_patients.append({
+                    "center_code": patient.center_code,
+                    "patient_id": patient.patient_id,
+                    "error": str(result)
+                })
+            else:
+                synced_patients.append(result)
+        
+        logger.info("Batch webhook synced %d of %d patient(s)", len(synced_patients), len(patients))
+        
+        return {
+            "status": "synced" if not failed_patients else "partial",
+            "message": f"{len(synced_patients)} of {len(patients)} patient(s) successfully synced to Girder",
+            "synced": len(synced_patients),
+            "synced_patients": synced_patients,
+            "failed_patients": failed_patients if failed_patients else None
+        }
+        
+    except Exception as e:
+        logger.error(f"Unexpected error processing batch webhook: {str(e)}", exc_info=True)
+        raise HTTPException(
+            status_code=500,
+            detail=f"Internal server error: {str(e)}"
+        )
+
+
 @app.post("/redcap/upload")
 async def upload_patient_files(
     center_code: str = Form(...),
@@ -188,19 +469,13 @@ async def upload_patient_files(
     3. Uploads all files to the patient folder
     """
     try:
-        logger.info(f"Received file upload for patient: {patient_id} from center: {center_code}")
-        logger.info(f"Number of files: {len(files)}")
+        logger.debug("Received %d file(s) for patient: %s from center: %s", len(files), patient_id, center_code)
         
         # Step 1: Get or create CHU center folder
         chu_folder_name = f"CHU_{center_code}"
         try:
-            chu_folder = get_or_create_folder(chu_folder_name, ROOT_FOLDER_ID, public=True)
-            # Ensure folder is accessible
-            try:
-                set_folder_access(chu_folder["_id"], public=True)
-            except GirderError:
-                logger.warning(f"Could not set access for CHU folder, continuing...")
-            logger.info(f"CHU folder '{chu_folder_name}' ready with ID: {chu_folder['_id']}")
+            chu_folder_id = await run_sync(_resolve_chu_folder, center_code, limiter=GIRDER_LIMITER)
+            logger.debug("CHU folder '%s' ready with ID: %s", chu_folder_name, chu_folder_id)
         except GirderError as e:
             logger.error(f"Failed to get/create CHU folder: {str(e)}")
             raise HTTPException(
@@ -210,13 +485,10 @@ async def upload_patient_files(
         
         # Step 2: Get or create patient folder
         try:
-            patient_folder = get_or_create_folder(patient_id, chu_folder["_id"], public=True)
-            # Ensure folder is accessible
-            try:
-                set_folder_access(patient_folder["_id"], public=True)
-            except GirderError:
-                logger.warning(f"Could not set access for patient folder, continuing...")
-            logger.info(f"Patient folder '{patient_id}' ready with ID: {patient_folder['_id']}")
+            chu_folder_id, patient_folder_id = await run_sync(
+                _resolve_patient_folder, center_code, patient_id, limiter=GIRDER_LIMITER
+            )
+            logger.debug("Patient folder '%s' ready with ID: %s", patient_id, patient_folder_id)
         except GirderError as e:
             logger.error(f"Failed to get/create patient folder: {str(e)}")
             raise HTTPException(
@@ -232,70 +504,76 @@ async def upload_patient_files(
             "sex": sex
         }
         try:
-            set_metadata(patient_folder["_id"], patient_data)
-            logger.info(f"Set metadata for patient {patient_id}")
+            await run_sync(set_metadata, patient_folder_id, patient_data, limiter=GIRDER_LIMITER)
+            logger.debug("Set metadata for patient %s", patient_id)
         except GirderError as e:
+            _forget_patient_folder(chu_folder_id, patient_id)
             logger.error(f"Failed to set metadata: {str(e)}")
             raise HTTPException(
                 status_code=500,
                 detail=f"Failed to set patient metadata: {str(e)}"
             )
         
-        # Step 4: Upload files (ZIP files uploaded as-is, no extraction)
-        uploaded_files = []
-        failed_files = []
+        # Step 4: Upload files concurrently (ZIP files uploaded as-is, no extraction)
+        semaphore = asyncio.Semaphore(UPLOAD_CONCURRENCY)
         
-        for file in files:
-            try:
-                file_contents = await file.read()
-                file_name = file.filename or "unnamed_file"
-                
-                # Upload file directly (ZIP files uploaded as-is for testing)
-                file_result = upload_file(
-                    file_contents,
-                    patient_folder["_id"],
-                    file_name
+        async def upload_one(file: UploadFile) -> dict:
+            file_name = file.filename or "unnamed_file"
+            async with semaphore:
+                # Stream the spooled upload straight to Girder from a worker thread
+                file_result = await run_sync(
+                    functools.partial(upload_file, file.file, patient_folder_id, file_name, size=file.size),
+                    limiter=GIRDER_LIMITER
                 )
-                uploaded_files.append({
-                    "name": file_name,
-                    "id": file_result.get("_id"),
-                    "size": file_result.get("size", len(file_contents))
-                })
-                logger.info(f"Successfully uploaded file: {file_name}")
-                    
-            except Exception as e:
-                logger.error(f"Failed to upload file {file.filename}: {str(e)}")
+            logger.debug("Uploaded file: %s", file_name)
+            return {
+                "name": file_name,
+                "id": file_result.get("_id"),
+                "size": file_result.get("size", file.size)
+            }
+        
+        results = await asyncio.gather(*(upload_one(file) for file in files), return_exceptions=True)
+        
+        uploaded_files = []
+        failed_files = []
+        for file, result in zip(files, results):
+            if isinstance(result, Exception):
+                logger.error(f"Failed to upload file {file.filename}: {str(result)}")
                 failed_files.append({
                     "name": file.filename,
-                    "error": str(e)
+                    "error": str(result)
                 })
+            else:
+                uploaded_files.append(result)
         
         message = f"Patient {patient_id} and {len(uploaded_files)} file(s) successfully synced to Girder"
+        logger.info(
+            "Synced patient %s and %d file(s) to Girder", patient_id, len(uploaded_files),
+            extra={"center_code": center_code, "patient_folder_id": patient_folder_id,
+                   "failed_files": len(failed_files)}
+        )
         
-        return JSONResponse(
-            status_code=200,
-            content={
-                "status": "synced",
-                "message": message,
-                "folder_structure": {
-                    "root": ROOT_FOLDER_ID,
-                    "chu_folder": {
-                        "name": chu_folder_name,
-                        "id": chu_folder["_id"]
-                    },
-                    "patient_folder": {
-                        "name": patient_id,
-                        "id": patient_folder["_id"]
-                    }
-                },
-                "patient_data": patient_data,
-                "uploaded_files": uploaded_files,
-                "upload_summary": {
-                    "total_files": len(uploaded_files)
+        return {
+            "status": "synced",
+            "message": message,
+            "folder_structure": {
+                "root": ROOT_FOLDER_ID,
+                "chu_folder": {
+                    "name": chu_folder_name,
+                    "id": chu_folder_id
                 },
-                "failed_files": failed_files if failed_files else None
-            }
-        )
+                "patient_folder": {
+                    "name": patient_id,
+                    "id": patient_folder_id
+                }
+            },
+            "patient_data": patient_data,
+            "uploaded_files": uploaded_files,
+            "upload_summary": {
+                "total_files": len(uploaded_files)
+            },
+            "failed_files": failed_files if failed_files else None
+        }
         
     except HTTPException:
         raise
@@ -308,19 +586,30 @@ async def upload_patient_files(
 
 
 @app.get("/health")
-async def health_check():
-    """Health check endpoint for monitoring"""
+async def health_check(refresh: bool = False):
+    """
+    Health check endpoint for monitoring.
+    
+    A successful Girder probe is reused for HEALTH_CACHE_TTL seconds so that
+    frequent liveness probes don't each hit Girder; pass refresh=true to
+    force a new probe.
+    """
     try:
-        # Try to access root folder to verify Girder connection
-        get_folder_by_id(ROOT_FOLDER_ID)
+        now = time.monotonic()
+        if refresh or now - _health_cache["checked_at"] >= HEALTH_CACHE_TTL:
+            # Try to access root folder to verify Girder connection
+            await run_sync(functools.partial(get_folder_by_id, ROOT_FOLDER_ID, use_cache=False),
+                           limiter=GIRDER_LIMITER)
+            _health_cache["checked_at"] = now
         return {
             "status": "healthy",
             "girder_connection": "ok",
             "root_folder_id": ROOT_FOLDER_ID
         }
     except Exception as e:
+        _health_cache["checked_at"] = -math.inf
         logger.error(f"Health check failed: {str(e)}")
-        return JSONResponse(
+        return ORJSONResponse(
             status_code=503,
             content={
                 "status": "unhealthy",
@@ -344,12 +633,32 @@ async def redcap_mimic_interface():
         raise HTTPException(status_code=404, detail="REDCap mimic interface not found")
 
 
+def _stream_structure(first_center: Optional[Dict], centers: Iterator[Dict]) -> Iterator[bytes]:
+    """Serialize {"structure": [...]} one center at a time, seeding the folder caches"""
+    yield b'{"structure":['
+    if first_center is not None:
+        _preload_folder_cache([first_center])
+        yield orjson.dumps(first_center)
+        for center in centers:
+            _preload_folder_cache([center])
+            yield b"," + orjson.dumps(center)
+    yield b"]}"
+
+
 @app.get("/api/structure")
 async def get_structure():
-    """Get complete structure for tree view"""
+    """
+    Get complete structure for tree view.
+    
+    The response is serialized and streamed center by center. The first
+    center is read up front, fetching every row from the database, so that
+    database errors still produce a 500 and no pooled connection is held
+    while the client downloads the body.
+    """
     try:
-        structure = db.get_full_structure()
-        return {"structure": structure}
+        centers = db.iter_structure()
+        first_center = await run_sync(next, centers, None, limiter=DB_LIMITER)
+        return StreamingResponse(_stream_structure(first_center, centers), media_type="application/json")
     except Exception as e:
         logger.error(f"Error getting structure: {str(e)}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"Error loading structure: {str(e)}")
@@ -373,33 +682,7 @@ async def upload_file_to_redcap(
     4. Return file_id for later sync
     """
     try:
-        # Get document type info
-        doc_type = db.get_document_type(document_type_id)
-        if not doc_type:
-            raise HTTPException(status_code=404, detail="Document type not found")
-        
-        # Create directory structure
-        center_code = doc_type['center_code']
-        patient_id = doc_type['patient_id']
-        visit_code = doc_type['visit_code']
-        doc_code = doc_type['document_code']
-        
-        file_dir = UPLOADS_DIR / center_code / patient_id / visit_code / doc_code
-        file_dir.mkdir(parents=True, exist_ok=True)
-        
-        # Save file to local disk
-        file_path = file_dir / file.filename
-        async with aiofiles.open(file_path, 'wb') as f:
-            content = await file.read()
-            await f.write(content)
-        
-        file_size = file_path.stat().st_size
-        mime_type = file.content_type or "application/octet-stream"
-        
-        # Save to database
-        file_id = db.create_file(
-            document_type_id, file.filename, str(file_path), file_size, mime_type
-        )
+        file_id, file_size = await _store_document_upload(document_type_id, file)
         
         logger.info(f"File uploaded to local disk: {file.filename} (ID: {file_id})")
         
@@ -435,33 +718,7 @@ async def upload_file_to_local(
     4. Return file_id for later sync
     """
     try:
-        # Get document type info
-        doc_type = db.get_document_type(document_type_id)
-        if not doc_type:
-            raise HTTPException(status_code=404, detail="Document type not found")
-        
-        # Create directory structure
-        center_code = doc_type['center_code']
-        patient_id = doc_type['patient_id']
-        visit_code = doc_type['visit_code']
-        doc_code = doc_type['document_code']
-        
-        file_dir = UPLOADS_DIR / center_code / patient_id / visit_code / doc_code
-        file_dir.mkdir(parents=True, exist_ok=True)
-        
-        # Save file to local disk
-        file_path = file_dir / file.filename
-        async with aiofiles.open(file_path, 'wb') as f:
-            content = await file.read()
-            await f.write(content)
-        
-        file_size = file_path.stat().st_size
-        mime_type = file.content_type or "application/octet-stream"
-        
-        # Save to database
-        file_id = db.create_file(
-            document_type_id, file.filename, str(file_path), file_size, mime_type
-        )
+        file_id, file_size = await _store_document_upload(document_type_id, file)
         
         logger.info(f"File uploaded to local disk: {file.filename} (ID: {file_id})")
         
@@ -484,14 +741,7 @@ async def upload_file_to_local(
 async def get_files(document_type_id: int):
     """Get files for a document type"""
     try:
-        conn = sqlite3.connect(db.db_path)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT * FROM files WHERE document_type_id = ? ORDER BY uploaded_at DESC
-        """, (document_type_id,))
-        files = [dict(row) for row in cursor.fetchall()]
-        conn.close()
+        files = await run_sync(db.get_files, document_type_id, limiter=DB_LIMITER)
         return {"files": files}
     except Exception as e:
         logger.error(f"Error getting files: {str(e)}", exc_info=True)
@@ -513,7 +763,7 @@ async def sync_to_girder(file_id: int = Form(...)):
     """
     try:
         # Get file with full path information
-        file_info = db.get_file_with_path_info(file_id)
+        file_info = await run_sync(db.get_file_with_path_info, file_id, limiter=DB_LIMITER)
         if not file_info:
             raise HTTPException(status_code=404, detail="File not found")
         
@@ -532,13 +782,8 @@ async def sync_to_girder(file_id: int = Form(...)):
         document_name = file_info['document_name']
         center_girder_name = f"CHU_{center_code}"
         
-        # Lookup Girder folder_id from database (much faster than API calls)
-        doc_folder_id = db.get_document_folder_id(
-            center_code=center_code,
-            patient_id=patient_id,
-            visit_name=visit_name,
-            document_name=document_name
-        )
+        # Girder folder_id comes from the same database lookup (much faster than API calls)
+        doc_folder_id = file_info['doc_girder_folder_id']
         
         if not doc_folder_id:
             raise HTTPException(
@@ -548,7 +793,7 @@ async def sync_to_girder(file_id: int = Form(...)):
         
         # Verify folder exists in Girder
         try:
-            folder_info = get_folder_by_id(doc_folder_id)
+            folder_info = await run_sync(get_folder_by_id, doc_folder_id, limiter=GIRDER_LIMITER)
         except GirderError as e:
             raise HTTPException(
                 status_code=404,
@@ -561,13 +806,12 @@ async def sync_to_girder(file_id: int = Form(...)):
             raise HTTPException(status_code=404, detail="File not found on disk")
         
         try:
-            with open(file_path, 'rb') as f:
-                file_data = f.read()
-            
-            girder_file = upload_file(file_data, doc_folder_id, file_info['filename'])
+            girder_file = await run_sync(
+                _upload_stored_file, file_info, doc_folder_id, limiter=GIRDER_LIMITER
+            )
             
             # Mark as synced
-            db.mark_file_synced(file_id, girder_file['_id'])
+            await run_sync(db.mark_file_synced, file_id, girder_file['_id'], limiter=DB_LIMITER)
             
             logger.info(f"File {file_info['filename']} synced to Girder successfully")
             
@@ -587,3 +831,17 @@ async def sync_to_girder(file_id: int = Form(...)):
         logger.error(f"Error syncing file to Girder: {str(e)}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"Error syncing file: {str(e)}")
 
+
+if __name__ == "__main__":
+    import uvicorn
+    
+    # uvloop and httptools ship with uvicorn[standard]; every worker is a
+    # separate process with its own event loop, connection pools and caches
+    uvicorn.run(
+        "app:app",
+        host=os.getenv("HOST", "0.0.0.0"),
+        port=int(os.getenv("PORT", "8000")),
+        loop="uvloop",
+        http="httptools",
+        workers=int(os.getenv("WEB_CONCURRENCY", str(os.cpu_count() or 1)))
+    )
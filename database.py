@@ -1,22 +1,345 @@
+import json
 import sqlite3
 import os
+import queue
+from contextlib import contextmanager
 from pathlib import Path
-from typing import List, Dict, Optional
+from typing import Dict, Iterator, List, Optional, Tuple
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Applied to every pooled connection when it is opened. journal_mode=WAL is
+# persistent, so init_database sets it once for the database file.
+CONNECTION_PRAGMAS = (
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA cache_size=-20000",
+    "PRAGMA foreign_keys=ON",
+    "PRAGMA busy_timeout=30000",
+)
+
+# Prepared statements kept per pooled connection. sqlite3 looks statements up
+# by SQL text, so every query in this module stays a constant string with
+# bound parameters and is only parsed once per connection.
+STATEMENT_CACHE_SIZE = 256
+
+# Columns added to the document_types table after its first release
+DOCUMENT_TYPES_MIGRATED_COLUMNS = (
+    ("lookup_key", "TEXT"),
+)
+
+# document_types columns returned to callers; lookup_key is internal to the
+# folder ID lookups
+DOCUMENT_TYPES_PUBLIC_COLUMNS = (
+    "id", "visit_id", "document_name", "document_code", "girder_folder_id", "created_at"
+)
+
+# Columns added to the files table after its first release, as (name, type).
+# init_database adds any that an existing database is missing.
+FILES_MIGRATED_COLUMNS = (
+    ("data_offset", "INTEGER"),
+    ("stored_size", "INTEGER"),
+    ("stored_encoding", "TEXT"),
+)
+
+# files columns returned to callers; the migrated columns locate a file's
+# data in storage and are only read by the code that opens stored files
+FILES_PUBLIC_COLUMNS = (
+    "id", "document_type_id", "filename", "file_path", "file_size", "mime_type",
+    "girder_file_id", "synced_to_girder", "uploaded_at"
+)
+
+
+def _document_lookup_key(center_code: str, patient_id: str, visit_name: str, document_name: str) -> str:
+    """Key of a document type in document_types.lookup_key, see _SQL_FILL_DOCUMENT_LOOKUP_KEYS"""
+    return f"{center_code}|{patient_id}|{visit_name}|{document_name}"
+
+
+def _document_code(document_name: str) -> str:
+    """Derive the code (used in shard paths) of a document type from its name"""
+    return document_name.lower().replace(" ", "_").replace("é", "e").replace("β", "beta")
+
+
+# Document types created for each visit code, as (document_name, document_code)
+DOCUMENT_TYPES_BY_VISIT = {
+    visit_code: tuple((name, _document_code(name)) for name in names)
+    for visit_code, names in {
+        "M0": ("Bilan Biologique", "Consentement_Eclaire", "Dosage des β HCG"),
+        "M-6": ("Bilan Biologique", "Consentement_Eclaire", "Dosage des β HCG", "ECG 12 derivations"),
+        "M12": ("Bilan Biologique", "Consentement_Eclaire", "Dosage des β HCG"),
+        "M24": ("Bilan Biologique", "Consentement_Eclaire", "Dosage des β HCG"),
+    }.items()
+}
+
+
+# Queries run by the Database methods. Keeping them as fixed strings with
+# bound parameters lets every pooled connection reuse its prepared statements.
+_SQL_SET_CENTER_FOLDER_ID = "UPDATE centers SET girder_folder_id = ? WHERE code = ?"
+
+_SQL_SET_PATIENT_FOLDER_ID = """
+    UPDATE patients SET girder_folder_id = ?
+    WHERE patient_id = ? AND center_id = (SELECT id FROM centers WHERE code = ?)
+"""
+
+# Folder ID updates by table, for the rows create_girder_schema creates folders for
+_SQL_SET_GIRDER_FOLDER_ID = {
+    table: f"UPDATE {table} SET girder_folder_id = ? WHERE id = ?"
+    for table in ("centers", "patients", "visits", "document_types")
+}
+
+_SQL_GET_DOCUMENT_TYPE = f"""
+    SELECT {", ".join(f"dt.{name}" for name in DOCUMENT_TYPES_PUBLIC_COLUMNS)}, v.visit_name, v.visit_code, p.patient_id, p.id as patient_db_id,
+           c.code as center_code, c.name as center_name
+    FROM document_types dt
+    JOIN visits v ON dt.visit_id = v.id
+    JOIN patients p ON v.patient_id = p.id
+    JOIN centers c ON p.center_id = c.id
+    WHERE dt.id = ?
+"""
+
+_SQL_CREATE_FILE = """
+    INSERT INTO files (document_type_id, filename, file_path, file_size, mime_type,
+                       data_offset, stored_size, stored_encoding)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+_SQL_MARK_FILE_SYNCED = """
+    UPDATE files SET synced_to_girder = 1, girder_file_id = ? WHERE id = ?
+"""
+
+_SQL_GET_FILE = f"SELECT {', '.join(FILES_PUBLIC_COLUMNS)} FROM files WHERE id = ?"
+
+_SQL_GET_FILES = f"""
+    SELECT {', '.join(FILES_PUBLIC_COLUMNS)} FROM files WHERE document_type_id = ? ORDER BY uploaded_at DESC
+"""
+
+_SQL_GET_FILE_WITH_PATH_INFO = """
+    SELECT f.*, 
+           dt.document_name, dt.document_code, dt.girder_folder_id as doc_girder_folder_id,
+           v.visit_name, v.visit_code, v.girder_folder_id as visit_girder_folder_id,
+           p.patient_id, p.girder_folder_id as patient_girder_folder_id,
+           c.code as center_code, c.name as center_name, c.girder_folder_id as center_girder_folder_id
+    FROM files f
+    JOIN document_types dt ON f.document_type_id = dt.id
+    JOIN visits v ON dt.visit_id = v.id
+    JOIN patients p ON v.patient_id = p.id
+    JOIN centers c ON p.center_id = c.id
+    WHERE f.id = ?
+"""
+
+# Materializes each document type's center code, patient ID, visit name and
+# document name into lookup_key, so folder IDs are found with one index probe
+_SQL_FILL_DOCUMENT_LOOKUP_KEYS = """
+    UPDATE document_types SET lookup_key = (
+        SELECT c.code || '|' || p.patient_id || '|' || v.visit_name || '|' || document_types.document_name
+        FROM visits v
+        JOIN patients p ON v.patient_id = p.id
+        JOIN centers c ON p.center_id = c.id
+        WHERE v.id = document_types.visit_id
+    )
+    WHERE lookup_key IS NULL
+"""
+
+_SQL_GET_DOCUMENT_FOLDER_ID = """
+    SELECT girder_folder_id FROM document_types WHERE lookup_key = ?
+"""
+
+# Folder map keys of the document types whose IDs are listed in a JSON array
+_SQL_GET_DOCUMENT_KEYS = """
+    SELECT dt.id, c.code, p.patient_id, v.visit_name, dt.document_name
+    FROM document_types dt
+    JOIN visits v ON dt.visit_id = v.id
+    JOIN patients p ON v.patient_id = p.id
+    JOIN centers c ON p.center_id = c.id
+    WHERE dt.id IN (SELECT value FROM json_each(?))
+"""
+
+_SQL_GET_DOCUMENT_FOLDER_IDS = """
+    SELECT c.code, p.patient_id, v.visit_name, dt.document_name, dt.girder_folder_id
+    FROM document_types dt
+    JOIN visits v ON dt.visit_id = v.id
+    JOIN patients p ON v.patient_id = p.id
+    JOIN centers c ON p.center_id = c.id
+    WHERE dt.girder_folder_id IS NOT NULL AND dt.girder_folder_id != ''
+"""
+
+
+def _build_structure_sql(columns: Dict[str, List[str]]) -> str:
+    """
+    Build the query returning the center → patient → visit → document type →
+    file tree as one JSON object per center row, assembled by SQLite.
+    
+    Every level is a json_object of all the table's columns (in SELECT * order)
+    plus an array of its children. Arrays are aggregated from ordered
+    subqueries, and nested JSON is passed through json() so it is embedded
+    rather than quoted as text.
+    """
+    def fields(alias: str, table: str) -> str:
+        return ", ".join(f"'{name}', {alias}.{name}" for name in columns[table])
+    
+    files = f"""
+        SELECT json_group_array(json(item)) FROM (
+            SELECT json_object({fields('f', 'files')}) AS item
+            FROM files f WHERE f.document_type_id = dt.id
+            ORDER BY f.uploaded_at DESC, f.id
+        )"""
+    document_types = f"""
+        SELECT json_group_array(json(item)) FROM (
+            SELECT json_object({fields('dt', 'document_types')}, 'files', json(({files}))) AS item
+            FROM document_types dt WHERE dt.visit_id = v.id
+            ORDER BY dt.document_name, dt.id
+        )"""
+    visits = f"""
+        SELECT json_group_array(json(item)) FROM (
+            SELECT json_object({fields('v', 'visits')}, 'document_types', json(({document_types}))) AS item
+            FROM visits v WHERE v.patient_id = p.id
+            ORDER BY v.visit_code
+        )"""
+    patients = f"""
+        SELECT json_group_array(json(item)) FROM (
+            SELECT json_object({fields('p', 'patients')}, 'visits', json(({visits}))) AS item
+            FROM patients p WHERE p.center_id = c.id
+            ORDER BY p.patient_id
+        )"""
+    return f"""
+        SELECT json_object({fields('c', 'centers')}, 'patients', json(({patients})))
+        FROM centers c
+        ORDER BY c.code"""
+
+
+def _insert_returning(cursor: sqlite3.Cursor, table: str, columns: tuple, rows: list,
+                      returning: str) -> list:
+    """
+    Insert rows with a single multi-row INSERT and return the RETURNING rows.
+    
+    RETURNING output is not guaranteed to follow the VALUES order, so callers
+    return the columns they need to match each generated ID to its row.
+    """
+    placeholders = "(" + ", ".join("?" * len(columns)) + ")"
+    cursor.execute(
+        f"INSERT INTO {table} ({', '.join(columns)}) "
+        f"VALUES {', '.join([placeholders] * len(rows))} RETURNING {returning}",
+        [value for row in rows for value in row]
+    )
+    return cursor.fetchall()
+
+
+class ConnectionPool:
+    """Fixed-size pool of long-lived SQLite connections shared across threads"""
+    
+    def __init__(self, db_path: str, size: int = 4, read_only: bool = False):
+        self.db_path = db_path
+        self.read_only = read_only
+        self._connections = queue.Queue(maxsize=size)
+        for _ in range(size):
+            self._connections.put(self._connect())
+    
+    def _connect(self) -> sqlite3.Connection:
+        if self.read_only:
+            database, uri = f"{Path(self.db_path).resolve().as_uri()}?mode=ro", True
+        else:
+            database, uri = self.db_path, False
+        conn = sqlite3.connect(
+            database,
+            uri=uri,
+            check_same_thread=False,
+            cached_statements=STATEMENT_CACHE_SIZE,
+            # Autocommit: single statements commit on their own and multi-statement
+            # work opens its transaction explicitly with BEGIN
+            isolation_level=None
+        )
+        conn.row_factory = sqlite3.Row
+        for pragma in CONNECTION_PRAGMAS:
+            conn.execute(pragma)
+        return conn
+    
+    @contextmanager
+    def acquire(self):
+        """Borrow a connection, blocking until one is free"""
+        conn = self._connections.get()
+        try:
+            yield conn
+        finally:
+            # Never hand a connection with a half-finished transaction to the next caller
+            if conn.in_transaction:
+                conn.rollback()
+            self._connections.put(conn)
+    
+    def close(self):
+        """Close all pooled connections"""
+        while not self._connections.empty():
+            conn = self._connections.get_nowait()
+            if not self.read_only:
+                # Refresh planner statistics for the queries this connection ran
+                conn.execute("PRAGMA optimize")
+            conn.close()
+
+
 class Database:
-    def __init__(self, db_path: str = "redcap_mimic.db"):
+    def __init__(self, db_path: str = "redcap_mimic.db", pool_size: int = 4):
         self.db_path = db_path
         self.init_database()
         self.populate_initial_data()
+        # SQLite allows one writer at a time, so writes share a single
+        # connection while queries use a pool of read-only connections
+        self._writer = ConnectionPool(db_path, size=1)
+        self._readers = ConnectionPool(db_path, size=pool_size, read_only=True)
+        # (center code, patient ID, visit name, document name) → Girder folder ID
+        # for every document type with a recorded folder
+        self._folder_map: Dict[tuple, str] = {}
+        self.load_document_folder_ids()
+        
+        # The structure query lists every column, so build it once for this
+        # schema (leaving out the internal document_types and files columns)
+        with self.acquire_readonly() as conn:
+            columns = {
+                table: [column[0] for column in conn.execute(f"SELECT * FROM {table} LIMIT 0").description]
+                for table in ("centers", "patients", "visits")
+            }
+        columns["document_types"] = list(DOCUMENT_TYPES_PUBLIC_COLUMNS)
+        columns["files"] = list(FILES_PUBLIC_COLUMNS)
+        self._structure_sql = _build_structure_sql(columns)
+    
+    def acquire(self):
+        """Borrow the read-write connection: `with db.acquire() as conn: ...`"""
+        return self._writer.acquire()
+    
+    def acquire_readonly(self):
+        """Borrow a pooled read-only connection: `with db.acquire_readonly() as conn: ...`"""
+        return self._readers.acquire()
+    
+    def load_document_folder_ids(self):
+        """(Re)load the document folder ID map with a single query"""
+        with self.acquire_readonly() as conn:
+            rows = conn.execute(_SQL_GET_DOCUMENT_FOLDER_IDS).fetchall()
+        self._folder_map = {tuple(row[:4]): row[4] for row in rows}
+    
+    def close(self):
+        """Close pooled connections"""
+        self._writer.close()
+        self._readers.close()
     
     def init_database(self):
-        """Initialize SQLite database with schema"""
-        conn = sqlite3.connect(self.db_path)
+        """
+        Initialize SQLite database with schema.
+        
+        Requires SQLite 3.35 or later for INSERT ... RETURNING.
+        """
+        if sqlite3.sqlite_version_info < (3, 35, 0):
+            raise RuntimeError(f"SQLite 3.35 or later is required, found {sqlite3.sqlite_version}")
+        
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
         cursor = conn.cursor()
         
+        # WAL lets readers run alongside the writer; the mode is stored in the
+        # database file and can't be changed inside a transaction
+        cursor.execute("PRAGMA journal_mode=WAL")
+        
+        # Serialize with other worker processes initializing at the same time
+        cursor.execute("BEGIN IMMEDIATE")
+        
         # Centers table
         cursor.execute("""
             CREATE TABLE IF NOT EXISTS centers (
@@ -64,6 +387,7 @@ class Database:
                 document_code TEXT NOT NULL,
                 girder_folder_id TEXT,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                lookup_key TEXT,
                 FOREIGN KEY (visit_id) REFERENCES visits(id),
                 UNIQUE(visit_id, document_code)
             )
@@ -81,22 +405,69 @@ class Database:
                 girder_file_id TEXT,
                 synced_to_girder BOOLEAN DEFAULT 0,
                 uploaded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                data_offset INTEGER,
+                stored_size INTEGER,
+                stored_encoding TEXT,
                 FOREIGN KEY (document_type_id) REFERENCES document_types(id)
             )
         """)
         
-        conn.commit()
+        for table, migrated_columns in (
+            ("files", FILES_MIGRATED_COLUMNS),
+            ("document_types", DOCUMENT_TYPES_MIGRATED_COLUMNS),
+        ):
+            existing_columns = {row[1] for row in cursor.execute(f"PRAGMA table_info({table})")}
+            for name, column_type in migrated_columns:
+                if name not in existing_columns:
+                    cursor.execute(f"ALTER TABLE {table} ADD COLUMN {name} {column_type}")
+        cursor.execute(_SQL_FILL_DOCUMENT_LOOKUP_KEYS)
+        
+        # Indexes for the lookup paths. patients(center_id, patient_id) and
+        # visits(patient_id, visit_code) are already indexed by their UNIQUE
+        # constraints. The other indexes end with the ORDER BY keys of the
+        # structure and file listing queries, so rows come back in index order
+        # without a temporary sort.
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_visits_patient_name
+            ON visits(patient_id, visit_name)
+        """)
+        # Superseded by idx_document_types_visit_document: its girder_folder_id
+        # column came before the rowid and forced a sort on (document_name, id)
+        cursor.execute("DROP INDEX IF EXISTS idx_document_types_visit_name")
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_document_types_visit_document
+            ON document_types(visit_id, document_name)
+        """)
+        cursor.execute("""
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_document_types_lookup_key
+            ON document_types(lookup_key)
+        """)
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_files_document_type
+            ON files(document_type_id, uploaded_at DESC)
+        """)
+        # Only unsynced files, in the upload order the sync reads them in, so
+        # the index stays small however many files have been synced
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_files_unsynced
+            ON files(uploaded_at) WHERE synced_to_girder = 0
+        """)
+        
+        cursor.execute("COMMIT")
         conn.close()
         logger.info("Database initialized")
     
     def populate_initial_data(self):
         """Pre-populate database with hospitals, patients, visits, and document types"""
-        conn = sqlite3.connect(self.db_path)
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
         cursor = conn.cursor()
         
-        # Check if data already exists
+        # Check if data already exists, holding the write lock so that only one
+        # worker process populates a new database
+        cursor.execute("BEGIN IMMEDIATE")
         cursor.execute("SELECT COUNT(*) FROM centers")
         if cursor.fetchone()[0] > 0:
+            cursor.execute("ROLLBACK")
             conn.close()
             logger.info("Initial data already populated")
             return
@@ -108,21 +479,26 @@ class Database:
             ("Toulouse", "CHU Toulouse")
         ]
         
-        center_ids = {}
-        for code, name in hospitals:
-            cursor.execute("INSERT INTO centers (code, name) VALUES (?, ?)", (code, name))
-            center_ids[code] = cursor.lastrowid
+        # Each table is inserted with one multi-row INSERT ... RETURNING, which
+        # hands back the generated IDs alongside the natural key of each row to
+        # build the child rows. (executemany discards RETURNING rows.)
+        center_ids = dict(_insert_returning(
+            cursor, "centers", ("code", "name"), hospitals, "code, id"
+        ))
         
         # Patients (2 per hospital)
-        patient_ids = {}
-        for center_code, center_id in center_ids.items():
-            for i in range(1, 3):
-                patient_id_str = f"Patient_{i:03d}"
-                cursor.execute(
-                    "INSERT INTO patients (center_id, patient_id) VALUES (?, ?)",
-                    (center_id, patient_id_str)
-                )
-                patient_ids[(center_code, patient_id_str)] = cursor.lastrowid
+        patient_rows = [
+            (center_ids[code], f"Patient_{i:03d}")
+            for code, _ in hospitals
+            for i in range(1, 3)
+        ]
+        patient_ids = {
+            (center_id, patient_id_str): patient_db_id
+            for patient_db_id, center_id, patient_id_str in _insert_returning(
+                cursor, "patients", ("center_id", "patient_id"), patient_rows,
+                "id, center_id, patient_id"
+            )
+        }
         
         # Visits (4 per patient)
         visit_mapping = {
@@ -132,172 +508,176 @@ class Database:
             "Visite M24": "M24"
         }
         
-        visit_ids = {}
-        for (center_code, patient_id_str), patient_db_id in patient_ids.items():
-            for visit_name, visit_code in visit_mapping.items():
-                cursor.execute(
-                    "INSERT INTO visits (patient_id, visit_name, visit_code) VALUES (?, ?, ?)",
-                    (patient_db_id, visit_name, visit_code)
-                )
-                visit_ids[(patient_db_id, visit_code)] = cursor.lastrowid
-        
-        # Document types per visit
-        document_types_config = {
-            "M0": ["Bilan Biologique", "Consentement_Eclaire", "Dosage des β HCG"],
-            "M-6": ["Bilan Biologique", "Consentement_Eclaire", "Dosage des β HCG", "ECG 12 derivations"],
-            "M12": ["Bilan Biologique", "Consentement_Eclaire", "Dosage des β HCG"],
-            "M24": ["Bilan Biologique", "Consentement_Eclaire", "Dosage des β HCG"]
+        visit_rows = [
+            (patient_ids[patient_key], visit_name, visit_code)
+            for patient_key in patient_rows
+            for visit_name, visit_code in visit_mapping.items()
+        ]
+        visit_ids = {
+            (patient_db_id, visit_code): visit_db_id
+            for visit_db_id, patient_db_id, visit_code in _insert_returning(
+                cursor, "visits", ("patient_id", "visit_name", "visit_code"), visit_rows,
+                "id, patient_id, visit_code"
+            )
         }
         
-        for (patient_db_id, visit_code), visit_db_id in visit_ids.items():
-            doc_types = document_types_config.get(visit_code, [])
-            for doc_name in doc_types:
-                doc_code = doc_name.lower().replace(" ", "_").replace("é", "e").replace("β", "beta")
-                cursor.execute(
-                    "INSERT INTO document_types (visit_id, document_name, document_code) VALUES (?, ?, ?)",
-                    (visit_db_id, doc_name, doc_code)
-                )
+        # Document types per visit
+        document_type_rows = [
+            (visit_ids[(patient_db_id, visit_code)], doc_name, doc_code)
+            for patient_db_id, _, visit_code in visit_rows
+            for doc_name, doc_code in DOCUMENT_TYPES_BY_VISIT.get(visit_code, ())
+        ]
+        _insert_returning(
+            cursor, "document_types", ("visit_id", "document_name", "document_code"),
+            document_type_rows, "id"
+        )
+        cursor.execute(_SQL_FILL_DOCUMENT_LOOKUP_KEYS)
         
-        conn.commit()
+        # All inserts land in this one transaction, with a single fsync
+        cursor.execute("COMMIT")
         conn.close()
         logger.info("Initial data populated successfully")
     
     def get_full_structure(self) -> List[Dict]:
         """Get complete structure for display"""
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
+        return list(self.iter_structure())
+    
+    def iter_structure(self) -> Iterator[Dict]:
+        """
+        Yield the complete structure one center at a time.
         
-        # Get all centers
-        cursor.execute("SELECT * FROM centers ORDER BY code")
-        centers = [dict(row) for row in cursor.fetchall()]
+        All rows are fetched (as JSON text) when iteration starts, so the
+        read-only connection goes back to the pool before the first center
+        is yielded; only parsing happens center by center.
+        """
+        with self.acquire_readonly() as conn:
+            rows = conn.execute(self._structure_sql).fetchall()
+        for row in rows:
+            yield json.loads(row[0])
+    
+    def set_center_folder_id(self, center_code: str, girder_folder_id: str) -> bool:
+        """
+        Record the Girder folder ID of a center.
         
-        result = []
-        for center in centers:
-            # Get patients for this center
-            cursor.execute("""
-                SELECT * FROM patients WHERE center_id = ? ORDER BY patient_id
-            """, (center['id'],))
-            patients = [dict(row) for row in cursor.fetchall()]
-            
-            center_data = {
-                **center,
-                'patients': []
-            }
-            
-            for patient in patients:
-                # Get visits for this patient
-                cursor.execute("""
-                    SELECT * FROM visits WHERE patient_id = ? ORDER BY visit_code
-                """, (patient['id'],))
-                visits = [dict(row) for row in cursor.fetchall()]
-                
-                patient_data = {
-                    **patient,
-                    'visits': []
-                }
-                
-                for visit in visits:
-                    # Get document types for this visit
-                    cursor.execute("""
-                        SELECT * FROM document_types WHERE visit_id = ? ORDER BY document_name
-                    """, (visit['id'],))
-                    document_types = [dict(row) for row in cursor.fetchall()]
-                    
-                    # Get files for each document type
-                    for doc_type in document_types:
-                        cursor.execute("""
-                            SELECT * FROM files WHERE document_type_id = ? ORDER BY uploaded_at DESC
-                        """, (doc_type['id'],))
-                        doc_type['files'] = [dict(row) for row in cursor.fetchall()]
-                    
-                    visit_data = {
-                        **visit,
-                        'document_types': document_types
-                    }
-                    patient_data['visits'].append(visit_data)
-                
-                center_data['patients'].append(patient_data)
-            
-            result.append(center_data)
+        Returns:
+            True if the center exists in the database, False otherwise
+        """
+        with self.acquire() as conn:
+            cursor = conn.execute(_SQL_SET_CENTER_FOLDER_ID, (girder_folder_id, center_code))
+            return cursor.rowcount > 0
+    
+    def set_patient_folder_id(self, center_code: str, patient_id: str, girder_folder_id: str) -> bool:
+        """
+        Record the Girder folder ID of a patient.
         
-        conn.close()
-        return result
+        Returns:
+            True if the patient exists in the database, False otherwise
+        """
+        with self.acquire() as conn:
+            cursor = conn.execute(_SQL_SET_PATIENT_FOLDER_ID, (girder_folder_id, patient_id, center_code))
+            return cursor.rowcount > 0
     
-    def get_document_type(self, document_type_id: int) -> Optional[Dict]:
-        """Get document type with related info"""
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
+    def set_girder_folder_ids(self, updates: Dict[str, List[Tuple[int, str]]]):
+        """
+        Record many Girder folder IDs in one transaction.
         
-        cursor.execute("""
-            SELECT dt.*, v.visit_name, v.visit_code, p.patient_id, p.id as patient_db_id,
-                   c.code as center_code, c.name as center_name
-            FROM document_types dt
-            JOIN visits v ON dt.visit_id = v.id
-            JOIN patients p ON v.patient_id = p.id
-            JOIN centers c ON p.center_id = c.id
-            WHERE dt.id = ?
-        """, (document_type_id,))
+        The folder map is updated with the recorded document type folders.
         
-        row = cursor.fetchone()
-        conn.close()
+        Args:
+            updates: Table name ("centers", "patients", "visits" or
+                "document_types") → list of (row id, girder_folder_id)
+        """
+        with self.acquire() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            for table, rows in updates.items():
+                conn.executemany(_SQL_SET_GIRDER_FOLDER_ID[table], [
+                    (girder_folder_id, row_id) for row_id, girder_folder_id in rows
+                ])
+            document_folder_ids = dict(updates.get("document_types", ()))
+            if document_folder_ids:
+                keys = conn.execute(
+                    _SQL_GET_DOCUMENT_KEYS, (json.dumps(list(document_folder_ids)),)
+                ).fetchall()
+            conn.execute("COMMIT")
+        
+        if document_folder_ids:
+            for row in keys:
+                self._folder_map[tuple(row[1:])] = document_folder_ids[row[0]]
+    
+    def get_document_type(self, document_type_id: int) -> Optional[Dict]:
+        """Get document type with related info"""
+        with self.acquire_readonly() as conn:
+            row = conn.execute(_SQL_GET_DOCUMENT_TYPE, (document_type_id,)).fetchone()
         return dict(row) if row else None
     
     def create_file(self, document_type_id: int, filename: str, file_path: str,
-                   file_size: int, mime_type: str) -> int:
-        """Create file record"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute("""
-            INSERT INTO files (document_type_id, filename, file_path, file_size, mime_type)
-            VALUES (?, ?, ?, ?, ?)
-        """, (document_type_id, filename, file_path, file_size, mime_type))
-        file_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
-        return file_id
+                   file_size: int, mime_type: str, data_offset: Optional[int] = None,
+                   stored_size: Optional[int] = None, stored_encoding: Optional[str] = None) -> int:
+        """
+        Create file record.
+        
+        data_offset locates the data when file_path is a shard; stored_size and
+        stored_encoding describe the bytes on disk when they are compressed.
+        """
+        return self.create_files([{
+            "document_type_id": document_type_id, "filename": filename, "file_path": file_path,
+            "file_size": file_size, "mime_type": mime_type, "data_offset": data_offset,
+            "stored_size": stored_size, "stored_encoding": stored_encoding,
+        }])[0]
+    
+    def create_files(self, records: List[Dict]) -> List[int]:
+        """
+        Create many file records in one transaction.
+        
+        Each record holds the create_file arguments by name. Returns the new
+        file IDs in the order of records.
+        """
+        rows = [
+            (
+                record["document_type_id"], record["filename"], record["file_path"],
+                record["file_size"], record["mime_type"], record.get("data_offset"),
+                record.get("stored_size"), record.get("stored_encoding")
+            )
+            for record in records
+        ]
+        with self.acquire() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany(_SQL_CREATE_FILE, rows)
+            # The write lock is held for the whole batch, so its IDs are consecutive
+            last_id = conn.execute("SELECT last_insert_rowid()").fetchone()[0]
+            conn.execute("COMMIT")
+        return list(range(last_id - len(rows) + 1, last_id + 1))
     
     def mark_file_synced(self, file_id: int, girder_file_id: str):
         """Mark file as synced to Girder"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute("""
-            UPDATE files SET synced_to_girder = 1, girder_file_id = ? WHERE id = ?
-        """, (girder_file_id, file_id))
-        conn.commit()
-        conn.close()
+        with self.acquire() as conn:
+            conn.execute(_SQL_MARK_FILE_SYNCED, (girder_file_id, file_id))
+    
+    def mark_files_synced(self, synced: List[Tuple[int, str]]):
+        """Mark many files as synced to Girder in one transaction, from (file_id, girder_file_id) pairs"""
+        with self.acquire() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany(_SQL_MARK_FILE_SYNCED, [
+                (girder_file_id, file_id) for file_id, girder_file_id in synced
+            ])
+            conn.execute("COMMIT")
     
     def get_file(self, file_id: int) -> Optional[Dict]:
         """Get file by ID"""
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM files WHERE id = ?", (file_id,))
-        row = cursor.fetchone()
-        conn.close()
+        with self.acquire_readonly() as conn:
+            row = conn.execute(_SQL_GET_FILE, (file_id,)).fetchone()
         return dict(row) if row else None
     
+    def get_files(self, document_type_id: int) -> List[Dict]:
+        """Get files for a document type, newest first"""
+        with self.acquire_readonly() as conn:
+            rows = conn.execute(_SQL_GET_FILES, (document_type_id,)).fetchall()
+        return [dict(row) for row in rows]
+    
     def get_file_with_path_info(self, file_id: int) -> Optional[Dict]:
         """Get file with full path information (center → patient → visit → document)"""
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT f.*, 
-                   dt.document_name, dt.document_code, dt.girder_folder_id as doc_girder_folder_id,
-                   v.visit_name, v.visit_code, v.girder_folder_id as visit_girder_folder_id,
-                   p.patient_id, p.girder_folder_id as patient_girder_folder_id,
-                   c.code as center_code, c.name as center_name, c.girder_folder_id as center_girder_folder_id
-            FROM files f
-            JOIN document_types dt ON f.document_type_id = dt.id
-            JOIN visits v ON dt.visit_id = v.id
-            JOIN patients p ON v.patient_id = p.id
-            JOIN centers c ON p.center_id = c.id
-            WHERE f.id = ?
-        """, (file_id,))
-        row = cursor.fetchone()
-        conn.close()
+        with self.acquire_readonly() as conn:
+            row = conn.execute(_SQL_GET_FILE_WITH_PATH_INFO, (file_id,)).fetchone()
         return dict(row) if row else None
     
     def get_document_folder_id(
@@ -308,8 +688,8 @@ class Database:
         document_name: str
     ) -> Optional[str]:
         """
-        Lookup Girder folder ID for a document type from database.
-        Fast database lookup - no Girder API call needed!
+        Lookup Girder folder ID for a document type from the preloaded map.
+        Fast in-memory lookup - no Girder API call needed!
         
         Args:
             center_code: Center code (e.g., "Bordeaux")
@@ -320,26 +700,13 @@ class Database:
         Returns:
             Girder folder ID if found, None otherwise
         """
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            SELECT dt.girder_folder_id
-            FROM document_types dt
-            JOIN visits v ON dt.visit_id = v.id
-            JOIN patients p ON v.patient_id = p.id
-            JOIN centers c ON p.center_id = c.id
-            WHERE c.code = ?
-              AND p.patient_id = ?
-              AND v.visit_name = ?
-              AND dt.document_name = ?
-        """, (center_code, patient_id, visit_name, document_name))
-        
-        row = cursor.fetchone()
-        conn.close()
-        
-        if row and row['girder_folder_id']:
-            return row['girder_folder_id']
-        return None
-
+        key = (center_code, patient_id, visit_name, document_name)
+        folder_id = self._folder_map.get(key)
+        if folder_id is None:
+            # Folder IDs are recorded by create_girder_schema in another process,
+            # so probe the database for this one key before reporting a miss
+            with self.acquire_readonly() as conn:
+                row = conn.execute(_SQL_GET_DOCUMENT_FOLDER_ID, (_document_lookup_key(*key),)).fetchone()
+            if row and row['girder_folder_id']:
+                folder_id = self._folder_map[key] = row['girder_folder_id']
+        return folder_id
@@ -1,8 +1,24 @@
 import requests
+import gzip
+import hashlib
+import http.client
+import io
+import json
+import orjson
 import os
 import logging
+import select
+import socket
+import tempfile
+import threading
 import time
+from collections import OrderedDict
+from datetime import datetime
+from urllib.parse import urlencode, urlsplit
+import urllib3
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 load_dotenv()
 
@@ -22,30 +38,63 @@ if not GIRDER_API_URL:
 if not API_KEY:
     raise RuntimeError("GIRDER_API_KEY is not set")
 
-# Exchange API key for token
-def get_girder_token(api_key, api_url):
+
+def _drop_throttled_connection(response, *args, **kwargs):
+    """Don't return connections the server is throttling (429/503) to the pool"""
+    if response.status_code in (429, 503):
+        response.raw.close()
+
+
+def _create_session():
+    """
+    Build the shared HTTP session used for every Girder call.
+    
+    Connections are kept alive and pooled, so repeated calls skip the TCP/TLS
+    handshake. Idempotent requests (GET/PUT) are retried with backoff on
+    connection errors and 429/5xx responses; POSTs are never replayed.
+    
+    The Girder token is passed per request rather than set on the session,
+    so downloads from other hosts through the same session don't carry it.
+    """
+    session = requests.Session()
+    retry = Retry(
+        total=5,
+        backoff_factor=0.3,
+        status_forcelist=(429, 500, 502, 503, 504)
+    )
+    adapter = HTTPAdapter(pool_connections=32, pool_maxsize=64, max_retries=retry)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers["Connection"] = "keep-alive"
+    session.hooks["response"].append(_drop_throttled_connection)
+    return session
+
+
+_session = _create_session()
+
+def _request_token(api_key, api_url):
     """
     Exchange API key for a Girder authentication token.
     
-    Args:
-        api_key: The API key string
-        api_url: Base Girder API URL
-        
     Returns:
-        Token string to use in Girder-Token header
+        Tuple of (token, expires_at) with expires_at as a POSIX timestamp
     """
     try:
         logger.info("Exchanging API key for authentication token...")
         # Send as form data (application/x-www-form-urlencoded)
-        r = requests.post(
+        r = _session.post(
             f"{api_url}/api_key/token",
             data={"key": api_key}  # Use 'data' for form data
         )
         r.raise_for_status()
-        response = r.json()
-        token = response['authToken']['token']
+        auth_token = _response_json(r)['authToken']
         logger.info("Successfully obtained authentication token")
-        return token
+        try:
+            expires_at = datetime.fromisoformat(auth_token['expires']).timestamp()
+        except (KeyError, TypeError, ValueError):
+            # Unknown expiry: refresh after an hour, or sooner if Girder rejects it
+            expires_at = time.time() + 3600
+        return auth_token['token'], expires_at
     except requests.exceptions.RequestException as e:
         logger.error(f"Failed to exchange API key for token: {str(e)}")
         if hasattr(e, 'response') and e.response is not None:
@@ -53,13 +102,294 @@ def get_girder_token(api_key, api_url):
             logger.error(f"Response body: {e.response.text}")
         raise RuntimeError(f"Authentication failed: {str(e)}")
 
+
+# Exchange API key for token
+def get_girder_token(api_key, api_url):
+    """
+    Exchange API key for a Girder authentication token.
+    
+    Args:
+        api_key: The API key string
+        api_url: Base Girder API URL
+        
+    Returns:
+        Token string to use in Girder-Token header
+    """
+    return _request_token(api_key, api_url)[0]
+
+
+class TokenManager:
+    """
+    Girder token for an API key, refreshed before it expires.
+    
+    The token is also saved to a cache file (readable by the user only) so
+    the next process using the same API key and URL skips the exchange.
+    """
+    
+    # Seconds before expiry at which the token is refreshed
+    REFRESH_MARGIN = 60
+    
+    def __init__(self, api_key, api_url, cache_path=None):
+        self.api_key = api_key
+        self.api_url = api_url
+        self.cache_path = cache_path or os.path.join(
+            os.getenv("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "girder_token.json"
+        )
+        # Identifies the API key in the cache file without storing it
+        self._key_id = hashlib.sha256(f"{api_url}\n{api_key}".encode()).hexdigest()
+        self._lock = threading.Lock()
+        self._token, self._expires_at = self._load_cached()
+    
+    def get(self):
+        """Return a token valid for at least REFRESH_MARGIN seconds"""
+        with self._lock:
+            if self._token is None or time.time() >= self._expires_at - self.REFRESH_MARGIN:
+                self._refresh()
+            return self._token
+    
+    def refresh(self, rejected_token=None):
+        """
+        Get a new token, e.g. after Girder rejected one.
+        
+        If `rejected_token` is given and another thread already replaced it,
+        the current token is returned without a new exchange.
+        """
+        with self._lock:
+            if rejected_token is None or rejected_token == self._token:
+                self._refresh()
+            return self._token
+    
+    def _refresh(self):
+        self._token, self._expires_at = _request_token(self.api_key, self.api_url)
+        self._save_cached()
+    
+    def _load_cached(self):
+        try:
+            with open(self.cache_path) as f:
+                cached = json.load(f)
+            if cached["key_id"] == self._key_id:
+                return cached["token"], cached["expires_at"]
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        return None, 0.0
+    
+    def _save_cached(self):
+        tmp_path = None
+        try:
+            cache_dir = os.path.dirname(self.cache_path)
+            os.makedirs(cache_dir, exist_ok=True)
+            # mkstemp creates the file 0600, and replacing the cache with it
+            # never leaves the token in a file with looser permissions
+            fd, tmp_path = tempfile.mkstemp(dir=cache_dir, prefix=".girder_token.")
+            with os.fdopen(fd, "w") as f:
+                json.dump({"key_id": self._key_id, "token": self._token, "expires_at": self._expires_at}, f)
+            os.replace(tmp_path, self.cache_path)
+        except OSError as e:
+            logger.warning(f"Could not cache Girder token in {self.cache_path}: {str(e)}")
+            if tmp_path is not None:
+                try:
+                    os.unlink(tmp_path)
+                except OSError:
+                    pass
+
+
+def _auth_headers():
+    """Headers authenticating a Girder request with the current token"""
+    return {"Girder-Token": _tokens.get()}
+
+
+def _response_json(r):
+    """Parse a response body with orjson, failing like r.json() on invalid JSON"""
+    try:
+        return orjson.loads(r.content)
+    except orjson.JSONDecodeError as e:
+        raise requests.exceptions.JSONDecodeError(e.msg, e.doc, e.pos)
+
+
+def _json_request(obj):
+    """
+    Headers and body for a Girder request with a JSON body serialized by orjson.
+    
+    With GZIP_REQUEST_BODIES, bodies of at least GZIP_MIN_SIZE bytes are
+    gzip-compressed and sent with Content-Encoding: gzip.
+    
+    Returns:
+        Tuple of (headers, data)
+    """
+    headers = {**_auth_headers(), "Content-Type": "application/json"}
+    data = orjson.dumps(obj)
+    if GZIP_REQUEST_BODIES and len(data) >= GZIP_MIN_SIZE:
+        headers["Content-Encoding"] = "gzip"
+        data = gzip.compress(data, compresslevel=6)
+    return headers, data
+
+
+def _refresh_rejected_token(response, *args, **kwargs):
+    """Resend a Girder request once with a new token when its token was rejected (401)"""
+    request = response.request
+    rejected_token = request.headers.get("Girder-Token")
+    if response.status_code != 401 or rejected_token is None or response.history:
+        return None
+    
+    token = _tokens.refresh(rejected_token)
+    response.content  # Release the connection back to the pool
+    response.close()
+    retry = request.copy()
+    retry.headers["Girder-Token"] = token
+    retried = response.connection.send(retry, **kwargs)
+    retried.history.append(response)
+    retried.request = retry
+    return retried
+
+
 # Get token from API key
-GIRDER_TOKEN = get_girder_token(API_KEY, GIRDER_API_URL)
-HEADERS = {"Girder-Token": GIRDER_TOKEN}
+_tokens = TokenManager(API_KEY, GIRDER_API_URL)
+_tokens.get()
+_session.hooks["response"].append(_refresh_rejected_token)
+_GIRDER_URL = urlsplit(GIRDER_API_URL)
 
 logger.info(f"Initialized Girder client with API URL: {GIRDER_API_URL}")
 
 
+# Use 10MB chunks to avoid hitting server limits
+CHUNK_SIZE = 10 * 1024 * 1024  # 10 MB
+
+# Once a chunk has been timed, chunks are sized from the measured upload
+# bandwidth to take about CHUNK_TARGET_SECONDS each, between MIN_CHUNK_SIZE
+# (Girder's default core.upload_minimum_chunk_size) and MAX_CHUNK_SIZE
+MIN_CHUNK_SIZE = 5 * 1024 * 1024
+MAX_CHUNK_SIZE = 32 * 1024 * 1024
+CHUNK_TARGET_SECONDS = 2.0
+
+# Chunk bytes that all uploads in flight may hold together; while several
+# uploads run, each one's chunks are capped at its share (but not below
+# MIN_CHUNK_SIZE)
+CHUNK_MEMORY_BUDGET = 128 * 1024 * 1024
+
+# Moving average of the upload bandwidth in bytes/s and the number of uploads
+# in flight, shared by all uploads and guarded by _upload_stats_lock
+_upload_bandwidth = None
+_active_uploads = 0
+_upload_stats_lock = threading.Lock()
+
+# Bytes between INFO progress logs of a chunked upload (other chunks log at DEBUG)
+PROGRESS_LOG_INTERVAL = 100 * 1024 * 1024
+
+# Seconds allowed for uploading one chunk
+CHUNK_TIMEOUT = 300
+
+# MIME types sent to Girder by file extension; others are application/octet-stream
+MIME_TYPES = {
+    '.dcm': 'application/dicom',
+    '.dicom': 'application/dicom',
+    '.jpg': 'image/jpeg',
+    '.jpeg': 'image/jpeg',
+    '.png': 'image/png',
+    '.pdf': 'application/pdf',
+    '.txt': 'text/plain',
+    '.csv': 'text/csv',
+    '.json': 'application/json',
+    '.zip': 'application/zip',
+    '.rar': 'application/x-rar-compressed',
+    '.7z': 'application/x-7z-compressed',
+    '.tar': 'application/x-tar',
+    '.gz': 'application/gzip',
+}
+
+# Extensions extract_and_upload_zip treats as DICOM files
+DICOM_EXTENSIONS = frozenset({'.dcm', '.dicom'})
+
+# Headers added to chunk POSTs; the response is a small JSON ack, so the
+# server isn't asked to compress it
+CHUNK_HEADERS = {"Accept-Encoding": "identity"}
+
+# JSON request bodies of at least GZIP_MIN_SIZE bytes are gzip-compressed when
+# GIRDER_GZIP_REQUESTS is set. Girder itself doesn't decode compressed request
+# bodies, so only enable it behind a proxy that does.
+GZIP_REQUEST_BODIES = os.getenv("GIRDER_GZIP_REQUESTS", "").lower() in ("1", "true", "yes")
+GZIP_MIN_SIZE = 4 * 1024
+
+# Seconds a sendfile chunk POST waits for 100 Continue before sending the body anyway
+EXPECT_CONTINUE_TIMEOUT = 1.0
+
+# Retries of a chunk the server throttles (429/503), and the delays between
+# them in seconds when it doesn't send Retry-After
+CHUNK_RETRIES = 5
+CHUNK_RETRY_DELAY = 0.5
+CHUNK_RETRY_MAX_DELAY = 30
+
+# Downloads of unknown size are spooled in memory up to DOWNLOAD_SPOOL_SIZE
+# bytes, then to a temporary file, reading DOWNLOAD_READ_SIZE bytes at a time
+DOWNLOAD_SPOOL_SIZE = 50 * 1024 * 1024
+DOWNLOAD_READ_SIZE = 1024 * 1024
+
+# Files of a ZIP archive uploaded at the same time (kept below the session's pool size)
+ZIP_UPLOAD_WORKERS = 16
+
+
+# Folder lookups are cached per process, bounded to FOLDER_CACHE_SIZE entries
+# each. find_folder remembers found folders for FOLDER_CACHE_TTL seconds and
+# misses for FOLDER_MISS_CACHE_TTL seconds (another process may create the
+# folder); get_folder_by_id remembers folders for FOLDER_CACHE_TTL seconds.
+FOLDER_CACHE_SIZE = 4096
+FOLDER_CACHE_TTL = 60
+FOLDER_MISS_CACHE_TTL = 5
+
+# Folders requested per page by list_children
+FOLDER_LIST_PAGE_SIZE = 500
+
+# (name, parent_id) -> (expires_at, folder or None)
+_find_folder_cache = OrderedDict()
+# folder_id -> (expires_at, folder)
+_folder_by_id_cache = OrderedDict()
+# parent_id -> (expires_at, {name: folder}) for parents listed by list_children
+_folder_children_cache = OrderedDict()
+_folder_cache_lock = threading.Lock()
+
+# Marks a key that isn't cached, since None is a cached find_folder miss
+_NOT_CACHED = object()
+
+
+def _cache_get(cache, key):
+    """Return the live cached value for `key`, or _NOT_CACHED"""
+    with _folder_cache_lock:
+        entry = cache.get(key)
+        if entry is None:
+            return _NOT_CACHED
+        if entry[0] <= time.monotonic():
+            del cache[key]
+            return _NOT_CACHED
+        cache.move_to_end(key)
+        return entry[1]
+
+
+def _cache_put(cache, key, value, ttl):
+    """Cache `value` under `key` for `ttl` seconds, evicting the least recently used entry"""
+    with _folder_cache_lock:
+        cache[key] = (time.monotonic() + ttl, value)
+        cache.move_to_end(key)
+        if len(cache) > FOLDER_CACHE_SIZE:
+            cache.popitem(last=False)
+
+
+def _forget_folder(folder_id):
+    """Drop every cached lookup of a folder, e.g. after Girder rejected it"""
+    with _folder_cache_lock:
+        _folder_by_id_cache.pop(folder_id, None)
+        _folder_children_cache.pop(folder_id, None)
+        for key, (_, folder) in list(_find_folder_cache.items()):
+            if folder is not None and folder.get('_id') == folder_id:
+                del _find_folder_cache[key]
+
+
+def clear_folder_caches():
+    """Forget all cached folder lookups"""
+    with _folder_cache_lock:
+        _find_folder_cache.clear()
+        _folder_by_id_cache.clear()
+        _folder_children_cache.clear()
+
+
 class GirderError(Exception):
     """Custom exception for Girder API errors"""
     pass
@@ -74,15 +404,22 @@ def find_folder(name, parent_id):
         parent_id: ID of the parent folder
         
     Returns:
-        Folder dict if found, None otherwise
+        Folder dict if found, None otherwise (both cached, see FOLDER_CACHE_TTL)
         
     Raises:
         GirderError: If API request fails
     """
+    folder = _cache_get(_find_folder_cache, (name, parent_id))
+    if folder is not _NOT_CACHED:
+        return folder
+    children = _cache_get(_folder_children_cache, parent_id)
+    if children is not _NOT_CACHED:
+        return children.get(name)
+    
     try:
-        r = requests.get(
+        r = _session.get(
             f"{GIRDER_API_URL}/folder",
-            headers=HEADERS,
+            headers=_auth_headers(),
             params={
                 "parentId": parent_id,
                 "parentType": "folder",
@@ -92,7 +429,7 @@ def find_folder(name, parent_id):
         )
         r.raise_for_status()
 
-        result = r.json()
+        result = _response_json(r)
 
         # Girder may return {"data": [...]} or directly [...]
         if isinstance(result, dict):
@@ -102,9 +439,11 @@ def find_folder(name, parent_id):
 
         folder = folders[0] if folders else None
         if folder:
-            logger.info(f"Found folder '{name}' with ID: {folder.get('_id')}")
+            logger.debug("Found folder '%s' with ID: %s", name, folder.get('_id'))
+            _cache_put(_find_folder_cache, (name, parent_id), folder, FOLDER_CACHE_TTL)
         else:
-            logger.debug(f"Folder '{name}' not found in parent {parent_id}")
+            logger.debug("Folder '%s' not found in parent %s", name, parent_id)
+            _cache_put(_find_folder_cache, (name, parent_id), None, FOLDER_MISS_CACHE_TTL)
         
         return folder
     except requests.exceptions.RequestException as e:
@@ -112,6 +451,56 @@ def find_folder(name, parent_id):
         raise GirderError(f"Failed to find folder: {str(e)}")
 
 
+def list_children(parent_id):
+    """
+    List the subfolders of a folder, paging through all of them.
+    
+    The listing is cached, so find_folder answers for any name under
+    `parent_id` without a request: found folders for FOLDER_CACHE_TTL
+    seconds, absent names for FOLDER_MISS_CACHE_TTL seconds. Call it before
+    looking up or creating many folders under the same parent.
+    
+    Args:
+        parent_id: ID of the parent folder
+        
+    Returns:
+        Dict mapping folder names to folder dicts
+        
+    Raises:
+        GirderError: If API request fails
+    """
+    children = {}
+    try:
+        while True:
+            r = _session.get(
+                f"{GIRDER_API_URL}/folder",
+                headers=_auth_headers(),
+                params={
+                    "parentId": parent_id,
+                    "parentType": "folder",
+                    "limit": FOLDER_LIST_PAGE_SIZE,
+                    "offset": len(children)
+                }
+            )
+            r.raise_for_status()
+            result = _response_json(r)
+            # Girder may return {"data": [...]} or directly [...]
+            page = result.get("data", []) if isinstance(result, dict) else result
+            for folder in page:
+                children[folder["name"]] = folder
+            if len(page) < FOLDER_LIST_PAGE_SIZE:
+                break
+    except requests.exceptions.RequestException as e:
+        logger.error(f"Error listing folders in {parent_id}: {str(e)}")
+        raise GirderError(f"Failed to list folders: {str(e)}")
+    
+    logger.debug("Listed %d folder(s) in parent %s", len(children), parent_id)
+    for name, folder in children.items():
+        _cache_put(_find_folder_cache, (name, parent_id), folder, FOLDER_CACHE_TTL)
+    _cache_put(_folder_children_cache, parent_id, children, FOLDER_MISS_CACHE_TTL)
+    return children
+
+
 def create_folder(name, parent_id, public=True):
     """
     Create a new folder in Girder.
@@ -128,10 +517,10 @@ def create_folder(name, parent_id, public=True):
         GirderError: If API request fails
     """
     try:
-        logger.info(f"Creating folder '{name}' in parent {parent_id} (public={public})")
-        r = requests.post(
+        logger.debug("Creating folder '%s' in parent %s (public=%s)", name, parent_id, public)
+        r = _session.post(
             f"{GIRDER_API_URL}/folder",
-            headers=HEADERS,
+            headers=_auth_headers(),
             data={
                 "name": name,
                 "parentId": parent_id,
@@ -140,11 +529,18 @@ def create_folder(name, parent_id, public=True):
             }
         )
         r.raise_for_status()
-        folder = r.json()
-        logger.info(f"Created folder '{name}' with ID: {folder.get('_id')}")
+        folder = _response_json(r)
+        logger.info("Created folder '%s' with ID: %s", name, folder.get('_id'))
+        _cache_put(_find_folder_cache, (name, parent_id), folder, FOLDER_CACHE_TTL)
+        _cache_put(_folder_by_id_cache, folder.get('_id'), folder, FOLDER_CACHE_TTL)
+        children = _cache_get(_folder_children_cache, parent_id)
+        if children is not _NOT_CACHED:
+            children[name] = folder
         return folder
     except requests.exceptions.RequestException as e:
         logger.error(f"Error creating folder '{name}': {str(e)}")
+        # The parent may have been deleted since it was cached
+        _forget_folder(parent_id)
         raise GirderError(f"Failed to create folder: {str(e)}")
 
 
@@ -181,25 +577,31 @@ def set_metadata(folder_id, metadata):
         GirderError: If API request fails
     """
     try:
-        logger.info(f"Setting metadata on folder {folder_id}")
-        r = requests.put(
+        logger.debug("Setting metadata on folder %s", folder_id)
+        headers, data = _json_request(metadata)
+        r = _session.put(
             f"{GIRDER_API_URL}/folder/{folder_id}/metadata",
-            headers=HEADERS,
-            json=metadata
+            headers=headers,
+            data=data
         )
         r.raise_for_status()
-        logger.info(f"Successfully set metadata on folder {folder_id}")
+        # The cached folder document still has the old metadata
+        with _folder_cache_lock:
+            _folder_by_id_cache.pop(folder_id, None)
+        logger.debug("Successfully set metadata on folder %s", folder_id)
     except requests.exceptions.RequestException as e:
         logger.error(f"Error setting metadata on folder {folder_id}: {str(e)}")
         raise GirderError(f"Failed to set metadata: {str(e)}")
 
 
-def get_folder_by_id(folder_id):
+def get_folder_by_id(folder_id, use_cache=True):
     """
     Get folder details by ID.
     
     Args:
         folder_id: ID of the folder
+        use_cache: Whether a folder cached in the last FOLDER_CACHE_TTL seconds
+            may be returned; pass False to always ask Girder
         
     Returns:
         Folder dict
@@ -207,26 +609,37 @@ def get_folder_by_id(folder_id):
     Raises:
         GirderError: If API request fails
     """
+    if use_cache:
+        folder = _cache_get(_folder_by_id_cache, folder_id)
+        if folder is not _NOT_CACHED:
+            return folder
+    
     try:
-        r = requests.get(
+        r = _session.get(
             f"{GIRDER_API_URL}/folder/{folder_id}",
-            headers=HEADERS
+            headers=_auth_headers()
         )
         r.raise_for_status()
-        return r.json()
+        folder = _response_json(r)
+        _cache_put(_folder_by_id_cache, folder_id, folder, FOLDER_CACHE_TTL)
+        return folder
     except requests.exceptions.RequestException as e:
         logger.error(f"Error getting folder {folder_id}: {str(e)}")
         raise GirderError(f"Failed to get folder: {str(e)}")
 
 
-def upload_file(file_path, folder_id, file_name=None):
+def upload_file(file_path, folder_id, file_name=None, size=None):
     """
     Upload a file to a Girder folder.
     
+    The data is streamed to Girder's chunked upload API, so at most one
+    chunk is held in memory at a time.
+    
     Args:
         file_path: Path to local file, bytes data, or file-like object
         folder_id: ID of the folder to upload to
         file_name: Name for the file (defaults to filename from path)
+        size: Size in bytes of a file-like object (detected by seeking if omitted)
         
     Returns:
         Created file dict
@@ -234,58 +647,59 @@ def upload_file(file_path, folder_id, file_name=None):
     Raises:
         GirderError: If API request fails
     """
-    import os
-    import io
-    from pathlib import Path
-    
-    # Handle file path or bytes
-    if isinstance(file_path, (str, Path)):
-        file_path = Path(file_path)
-        file_name = file_name or file_path.name
-        file_size = file_path.stat().st_size
+    # Handle file path or bytes. The size comes from the open handle, so a
+    # path is only resolved once.
+    if isinstance(file_path, (str, os.PathLike)):
+        file_name = file_name or os.path.basename(file_path)
         with open(file_path, 'rb') as f:
-            file_data = f.read()
+            return _upload_stream(f, os.fstat(f.fileno()).st_size, folder_id, file_name)
     elif isinstance(file_path, bytes):
-        # Assume bytes data
-        file_data = file_path
-        file_size = len(file_data)
+        # Assume bytes data. BytesIO shares the bytes object's buffer until it
+        # is written to, so this doesn't copy the data.
         if not file_name:
             raise ValueError("file_name is required when file_path is bytes")
+        return _upload_stream(io.BytesIO(file_path), len(file_path), folder_id, file_name)
     else:
-        # Assume file-like object
-        file_data = file_path.read()
-        file_size = len(file_data)
+        # Assume file-like object, read from its current position
         file_name = file_name or "uploaded_file"
+        if size is None:
+            start = file_path.tell()
+            size = file_path.seek(0, io.SEEK_END) - start
+            file_path.seek(start)
+        return _upload_stream(file_path, size, folder_id, file_name)
+
+
+def _upload_stream(file_io, file_size, folder_id, file_name):
+    """
+    Upload `file_size` bytes read from `file_io` to a Girder folder.
+    
+    Args:
+        file_io: Binary file-like object positioned at the start of the data
+        file_size: Number of bytes to upload
+        folder_id: ID of the folder to upload to
+        file_name: Name for the file in Girder
+        
+    Returns:
+        Created file dict
+        
+    Raises:
+        GirderError: If API request fails
+    """
+    global _active_uploads
     
     # Detect MIME type from extension
-    mime_type = "application/octet-stream"
-    if file_name:
-        ext = Path(file_name).suffix.lower()
-        mime_map = {
-            '.dcm': 'application/dicom',
-            '.dicom': 'application/dicom',
-            '.jpg': 'image/jpeg',
-            '.jpeg': 'image/jpeg',
-            '.png': 'image/png',
-            '.pdf': 'application/pdf',
-            '.txt': 'text/plain',
-            '.csv': 'text/csv',
-            '.json': 'application/json',
-            '.zip': 'application/zip',
-            '.rar': 'application/x-rar-compressed',
-            '.7z': 'application/x-7z-compressed',
-            '.tar': 'application/x-tar',
-            '.gz': 'application/gzip',
-        }
-        mime_type = mime_map.get(ext, 'application/octet-stream')
+    mime_type = MIME_TYPES.get(os.path.splitext(file_name)[1].lower(), "application/octet-stream")
     
+    sendfile_conn = _open_sendfile_connection(file_io)
+    with _upload_stats_lock:
+        _active_uploads += 1
     try:
-        logger.info(f"Initializing upload for {file_name} ({file_size} bytes) to folder {folder_id}")
+        logger.debug("Initializing upload for %s (%d bytes) to folder %s", file_name, file_size, folder_id)
         
         # Step 1: Initialize upload
-        r = requests.post(
+        r = _session.post(
             f"{GIRDER_API_URL}/file",
-            headers=HEADERS,
+            headers=_auth_headers(),
             params={
                 "parentType": "folder",
                 "parentId": folder_id,
@@ -295,101 +709,50 @@ def upload_file(file_path, folder_id, file_name=None):
             }
         )
         r.raise_for_status()
-        upload = r.json()
+        upload = _response_json(r)
         upload_id = upload["_id"]
         
         # Step 2: Upload file data in chunks (for large files)
-        # Use 10MB chunks to avoid hitting server limits
-        CHUNK_SIZE = 10 * 1024 * 1024  # 10 MB
-        
-        if file_size <= CHUNK_SIZE:
+        chunk_size = _chunk_size()
+        if file_size <= chunk_size:
             # Small file - upload in one chunk
-            logger.info(f"Uploading file data for {file_name} (single chunk)")
-            r = requests.post(
-                f"{GIRDER_API_URL}/file/chunk",
-                headers=HEADERS,
-                params={
-                    "uploadId": upload_id,
-                    "offset": 0
-                },
-                data=file_data
-            )
-            r.raise_for_status()
-            file_result = r.json()
+            logger.debug("Uploading file data for %s (single chunk)", file_name)
+            file_result = _post_chunk(file_io, upload_id, 0, file_size, sendfile_conn)
         else:
-            # Large file - upload in chunks
-            logger.info(f"Uploading large file {file_name} in chunks (chunk size: {CHUNK_SIZE / (1024*1024):.1f} MB)")
+            # Large file - upload in chunks, reading each one from the stream
+            logger.info("Uploading large file %s in chunks (chunk size: %.1f MB)", file_name, chunk_size / (1024*1024))
             offset = 0
-            file_io = io.BytesIO(file_data) if isinstance(file_data, bytes) else file_data
-            
-            # Ensure we start from the beginning
-            if hasattr(file_io, 'seek'):
-                file_io.seek(0)
-            
+            next_progress_log = 0
             file_result = None
             
             while offset < file_size:
-                # Read chunk
-                chunk_size = min(CHUNK_SIZE, file_size - offset)
-                chunk_data = file_io.read(chunk_size)
+                chunk_size = min(_chunk_size(), file_size - offset)
                 
-                if not chunk_data:
-                    break
-                
-                percent = (offset * 100) // file_size if file_size > 0 else 0
-                logger.info(f"Uploading chunk: {offset}/{file_size} bytes ({percent}%)")
+                # Progress goes to INFO once per PROGRESS_LOG_INTERVAL bytes
+                if offset >= next_progress_log:
+                    logger.info("Uploading %s: %d/%d bytes (%d%%)", file_name, offset, file_size, offset * 100 // file_size)
+                    next_progress_log = offset + PROGRESS_LOG_INTERVAL
+                else:
+                    logger.debug("Uploading chunk: %d/%d bytes", offset, file_size)
                 
                 # Upload chunk with timeout for large files
-                r = requests.post(
-                    f"{GIRDER_API_URL}/file/chunk",
-                    headers=HEADERS,
-                    params={
-                        "uploadId": upload_id,
-                        "offset": offset
-                    },
-                    data=chunk_data,
-                    timeout=300  # 5 minute timeout per chunk
-                )
-                r.raise_for_status()
-                
-                # Check response
-                result = r.json()
+                started = time.monotonic()
+                result = _post_chunk(file_io, upload_id, offset, chunk_size, sendfile_conn, timeout=CHUNK_TIMEOUT)
+                _record_chunk_time(chunk_size, time.monotonic() - started)
                 
                 # Update offset from server response (if provided)
                 if 'received' in result:
                     offset = result['received']
                 else:
                     # Fallback: update offset manually
-                    offset += len(chunk_data)
+                    offset += chunk_size
                 
-                # Check if this is the final chunk (offset >= file_size)
+                # After the final chunk Girder answers with the file document
                 if offset >= file_size:
-                    # This should be the file document
                     if '_id' in result and 'size' in result:
                         file_result = result
-                        logger.info(f"Upload complete: {file_name} (all chunks uploaded)")
-                        break
-                    else:
-                        # Sometimes need to wait a moment for server to finalize
-                        logger.info("Final chunk uploaded, waiting for server to finalize...")
-                        time.sleep(0.5)
-                        # Try to get the file from the upload status
-                        # The file should be available now
-                        if '_id' in result:
-                            file_result = result
-                            break
-                        else:
-                            # Last resort: check if upload is complete by getting upload status
-                            logger.warning("Checking upload status after final chunk...")
-                            # Continue - the file should be available
-                            break
-                
-                # Small delay to avoid overwhelming the server
-                time.sleep(0.1)
-            
-            # Close file if it's a BytesIO
-            if isinstance(file_io, io.BytesIO):
-                file_io.close()
+                        logger.debug("Upload complete: %s (all chunks uploaded)", file_name)
+                    break
             
             # Verify upload completed
             if not file_result:
@@ -399,7 +762,7 @@ def upload_file(file_path, folder_id, file_name=None):
             if file_result.get('size') != file_size:
                 logger.warning(f"File size mismatch: expected {file_size}, got {file_result.get('size')}")
         
-        logger.info(f"Successfully uploaded {file_name} with ID: {file_result.get('_id')}")
+        logger.info("Successfully uploaded %s with ID: %s", file_name, file_result.get('_id'))
         return file_result
     except requests.exceptions.RequestException as e:
         logger.error(f"Error uploading file '{file_name}': {str(e)}")
@@ -407,12 +770,184 @@ def upload_file(file_path, folder_id, file_name=None):
             logger.error(f"Response status: {e.response.status_code}")
             logger.error(f"Response body: {e.response.text}")
         raise GirderError(f"Failed to upload file: {str(e)}")
+    finally:
+        if sendfile_conn is not None:
+            sendfile_conn.close()
+        with _upload_stats_lock:
+            _active_uploads -= 1
+
+
+def _chunk_size():
+    """Size of the next chunk: CHUNK_TARGET_SECONDS at the measured bandwidth, clamped"""
+    with _upload_stats_lock:
+        bandwidth, active_uploads = _upload_bandwidth, max(_active_uploads, 1)
+    max_chunk_size = max(MIN_CHUNK_SIZE, min(MAX_CHUNK_SIZE, CHUNK_MEMORY_BUDGET // active_uploads))
+    if bandwidth is None:
+        return min(CHUNK_SIZE, max_chunk_size)
+    return int(min(max_chunk_size, max(MIN_CHUNK_SIZE, bandwidth * CHUNK_TARGET_SECONDS)))
+
+
+def _record_chunk_time(size, seconds):
+    """Fold the bandwidth of an uploaded chunk into the moving average"""
+    global _upload_bandwidth
+    # Smaller chunks mostly measure latency rather than bandwidth
+    if size < MIN_CHUNK_SIZE or seconds <= 0:
+        return
+    sample = size / seconds
+    with _upload_stats_lock:
+        if _upload_bandwidth is None:
+            _upload_bandwidth = sample
+        else:
+            _upload_bandwidth = 0.7 * _upload_bandwidth + 0.3 * sample
+
+
+def _open_sendfile_connection(file_io):
+    """
+    Open a dedicated connection for sending chunks of `file_io` with sendfile(2).
+    
+    The kernel then copies file data straight from the page cache to the
+    socket. Only possible for regular files sent over plain HTTP (TLS has to
+    encrypt in user space); returns None otherwise.
+    """
+    if not hasattr(os, "sendfile") or _GIRDER_URL.scheme != "http":
+        return None
+    if not isinstance(getattr(file_io, "raw", None), io.FileIO):
+        return None
+    return http.client.HTTPConnection(_GIRDER_URL.hostname, _GIRDER_URL.port, timeout=CHUNK_TIMEOUT)
+
+
+def _post_chunk(file_io, upload_id, offset, size, sendfile_conn=None, timeout=None):
+    """
+    Upload the next `size` bytes of `file_io` as the chunk starting at `offset`.
+    
+    A chunk the server throttles (429/503) is sent again after the delay in
+    its Retry-After header, or after a delay doubling from CHUNK_RETRY_DELAY,
+    at most CHUNK_RETRIES times. A chunk rejected for its token (401) is
+    sent again once with a new token.
+    
+    Returns:
+        Response JSON: the upload document, or the file document after the last chunk
+    """
+    params = {"uploadId": upload_id, "offset": offset}
+    if sendfile_conn is None:
+        data = file_io.read(size)
+        if len(data) != size:
+            raise GirderError(f"Unexpected end of data at offset {offset + len(data)}")
+        send = lambda: _send_chunk(data, params, timeout)
+    else:
+        start = file_io.tell()
+        send = lambda: _sendfile_chunk(sendfile_conn, file_io, start, size, params, token)
+    
+    delay = CHUNK_RETRY_DELAY
+    token_refreshed = False
+    attempt = 0
+    while True:
+        token = _tokens.get()
+        status, reason, retry_after, body = send()
+        if status == 401 and sendfile_conn is not None and not token_refreshed:
+            # The session resends rejected requests itself; this connection doesn't
+            _tokens.refresh(token)
+            token_refreshed = True
+            continue
+        if status not in (429, 503) or attempt == CHUNK_RETRIES:
+            break
+        attempt += 1
+        wait = min(_parse_retry_after(retry_after) or delay, CHUNK_RETRY_MAX_DELAY)
+        logger.warning(f"Chunk at offset {offset} throttled ({status}), retrying in {wait:.1f}s")
+        time.sleep(wait)
+        delay = min(delay * 2, CHUNK_RETRY_MAX_DELAY)
+    
+    if status >= 400:
+        logger.error(f"Response status: {status}")
+        logger.error(f"Response body: {body.decode(errors='replace')}")
+        raise GirderError(f"Failed to upload file: {status} {reason}")
+    return orjson.loads(body)
+
+
+def _parse_retry_after(value):
+    """Seconds to wait from a Retry-After header, or None if absent or an HTTP date"""
+    try:
+        return max(float(value), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def _send_chunk(data, params, timeout):
+    """POST a chunk held in memory; returns (status, reason, Retry-After, body)"""
+    r = _session.post(
+        f"{GIRDER_API_URL}/file/chunk",
+        headers={**_auth_headers(), **CHUNK_HEADERS},
+        params=params,
+        data=data,
+        timeout=timeout
+    )
+    return r.status_code, r.reason, r.headers.get("Retry-After"), r.content
+
+
+def _sendfile_chunk(sendfile_conn, file_io, start, size, params, token):
+    """
+    POST `size` bytes of `file_io` from `start` with sendfile.
+    
+    The request asks for 100-continue, so a chunk the server rejects on its
+    headers (expired token, throttling) is answered before the body is sent.
+    
+    Returns:
+        Tuple of (status, reason, Retry-After header, body)
+    """
+    try:
+        sendfile_conn.putrequest("POST", f"{_GIRDER_URL.path}/file/chunk?{urlencode(params)}")
+        sendfile_conn.putheader("Girder-Token", token)
+        for name, value in CHUNK_HEADERS.items():
+            sendfile_conn.putheader(name, value)
+        sendfile_conn.putheader("Content-Length", str(size))
+        sendfile_conn.putheader("Expect", "100-continue")
+        sendfile_conn.endheaders()
+        if _await_continue(sendfile_conn.sock):
+            sent = sendfile_conn.sock.sendfile(file_io, start, size)
+            if sent != size:
+                sendfile_conn.close()
+                raise GirderError(f"Unexpected end of data at offset {params['offset'] + sent}")
+            response = sendfile_conn.getresponse()
+            body = response.read()
+        else:
+            response = sendfile_conn.getresponse()
+            body = response.read()
+            # The announced body was never sent, so the connection can't be reused
+            sendfile_conn.close()
+    except (OSError, http.client.HTTPException) as e:
+        sendfile_conn.close()
+        raise GirderError(f"Failed to upload file: {str(e)}")
+    return response.status, response.reason, response.getheader("Retry-After"), body
+
+
+def _await_continue(sock):
+    """
+    Wait for the server's reply to Expect: 100-continue.
+    
+    Consumes a 100 Continue interim response. Returns False if the server
+    sent its final response instead; True if the body should be sent, which
+    includes servers that stay silent for EXPECT_CONTINUE_TIMEOUT seconds.
+    """
+    readable, _, _ = select.select([sock], [], [], EXPECT_CONTINUE_TIMEOUT)
+    if not readable:
+        return True
+    head = sock.recv(4096, socket.MSG_PEEK)
+    if not head.startswith((b"HTTP/1.1 100 ", b"HTTP/1.0 100 ")):
+        return False
+    end = head.find(b"\r\n\r\n")
+    if end < 0:
+        raise http.client.HTTPException("Incomplete 100 Continue response")
+    sock.recv(end + 4)
+    return True
 
 
 def download_and_upload_file(file_url, folder_id, file_name):
     """
     Download a file from a URL and upload it to Girder.
     
+    The body is streamed into the upload when its size is known, otherwise
+    it is spooled first (to disk past DOWNLOAD_SPOOL_SIZE bytes).
+    
     Args:
         file_url: URL to download file from
         folder_id: ID of the folder to upload to
@@ -426,41 +961,92 @@ def download_and_upload_file(file_url, folder_id, file_name):
     """
     try:
         logger.info(f"Downloading file from {file_url}")
-        response = requests.get(file_url, stream=True, timeout=30)
+        response = _session.get(file_url, stream=True, timeout=30)
         response.raise_for_status()
         
-        # Download to memory (for small files) or temp file (for large files)
-        file_data = response.content
-        logger.info(f"Downloaded {len(file_data)} bytes from {file_url}")
-        
-        return upload_file(file_data, folder_id, file_name)
-    except requests.exceptions.RequestException as e:
+        with response:
+            # Content-Length is the size on the wire, which only matches the
+            # file when the body isn't compressed
+            content_length = response.headers.get("Content-Length")
+            if content_length is not None and "Content-Encoding" not in response.headers:
+                logger.info(f"Streaming {content_length} bytes from {file_url}")
+                return upload_file(response.raw, folder_id, file_name, size=int(content_length))
+            
+            # Unknown size: spool the body, in memory while it is small
+            with tempfile.SpooledTemporaryFile(max_size=DOWNLOAD_SPOOL_SIZE) as spool:
+                for chunk in response.iter_content(chunk_size=DOWNLOAD_READ_SIZE):
+                    spool.write(chunk)
+                file_size = spool.tell()
+                spool.seek(0)
+                logger.info(f"Downloaded {file_size} bytes from {file_url}")
+                return upload_file(spool, folder_id, file_name, size=file_size)
+    except (requests.exceptions.RequestException, urllib3.exceptions.HTTPError) as e:
         logger.error(f"Error downloading file from {file_url}: {str(e)}")
         raise GirderError(f"Failed to download and upload file: {str(e)}")
 
 
-def extract_and_upload_zip(zip_data, folder_id, zip_name=None, extract_dicom=True):
+def _upload_zip_member(zip_file, info, folder_id):
+    """
+    Stream one ZIP member to Girder (run in a worker thread).
+    
+    The member is decompressed chunk by chunk as it is uploaded.
+    
+    Returns:
+        Uploaded file dict with 'name', 'original_path', 'id', 'size', or None
+        if the member is a directory or failed to upload
+    """
+    file_path = info.filename
+    try:
+        # Use the filename from the ZIP (preserve directory structure in name)
+        file_name = os.path.basename(file_path)
+        if not file_name:
+            # Skip directories
+            return None
+        
+        logger.debug("Extracting and uploading: %s (%d bytes)", file_name, info.file_size)
+        
+        # Upload to Girder. Open members read the archive through a shared,
+        # locked handle, so several can be streamed at the same time.
+        with zip_file.open(info) as src:
+            file_result = upload_file(src, folder_id, file_name, size=info.file_size)
+        
+        return {
+            "name": file_name,
+            "original_path": file_path,
+            "id": file_result.get("_id"),
+            "size": file_result.get("size", info.file_size)
+        }
+    except Exception as e:
+        logger.error(f"Failed to extract/upload {file_path} from ZIP: {str(e)}")
+        return None
+
+
+def extract_and_upload_zip(zip_data, folder_id, zip_name=None, extract_dicom=True,
+                           max_workers=ZIP_UPLOAD_WORKERS):
     """
     Extract a ZIP archive and upload all files (or just DICOM files) to Girder.
     
+    Files are uploaded concurrently by up to `max_workers` threads; a file
+    that fails is logged and skipped.
+    
     Args:
         zip_data: ZIP file data as bytes
         folder_id: ID of the folder to upload extracted files to
         zip_name: Name of the ZIP file (for logging)
         extract_dicom: If True, only extract DICOM files. If False, extract all files.
+        max_workers: Maximum number of files uploaded at the same time
         
     Returns:
-        List of uploaded file dicts with 'name', 'id', 'size'
+        List of uploaded file dicts with 'name', 'id', 'size', in archive order
         
     Raises:
         GirderError: If extraction or upload fails
     """
     import zipfile
     import io
-    from pathlib import Path
+    from concurrent.futures import ThreadPoolExecutor
     
     zip_name = zip_name or "archive.zip"
-    uploaded_files = []
     
     try:
         logger.info(f"Extracting ZIP archive: {zip_name} ({len(zip_data)} bytes)")
@@ -469,16 +1055,15 @@ def extract_and_upload_zip(zip_data, folder_id, zip_name=None, extract_dicom=Tru
         zip_file = zipfile.ZipFile(io.BytesIO(zip_data))
         
         # Get list of files in ZIP
-        file_list = zip_file.namelist()
+        file_list = zip_file.infolist()
         logger.info(f"Found {len(file_list)} file(s) in ZIP archive")
         
         # Filter for DICOM files if requested
         if extract_dicom:
-            dicom_extensions = {'.dcm', '.dicom'}
             original_count = len(file_list)
             file_list = [
-                f for f in file_list 
-                if Path(f).suffix.lower() in dicom_extensions and not f.endswith('/')
+                info for info in file_list 
+                if os.path.splitext(info.filename)[1].lower() in DICOM_EXTENSIONS and not info.is_dir()
             ]
             logger.info(f"Filtered to {len(file_list)} DICOM file(s) from {original_count} total file(s)")
         
@@ -486,36 +1071,14 @@ def extract_and_upload_zip(zip_data, folder_id, zip_name=None, extract_dicom=Tru
             logger.warning(f"No files found in ZIP archive {zip_name} (or no DICOM files if extract_dicom=True)")
             return []
         
-        # Extract and upload each file
-        for file_path in file_list:
-            try:
-                # Get file data from ZIP
-                file_data = zip_file.read(file_path)
-                
-                # Use the filename from the ZIP (preserve directory structure in name)
-                file_name = Path(file_path).name
-                if not file_name:
-                    # Skip directories
-                    continue
-                
-                logger.info(f"Extracting and uploading: {file_name} ({len(file_data)} bytes)")
-                
-                # Upload to Girder
-                file_result = upload_file(file_data, folder_id, file_name)
-                
-                uploaded_files.append({
-                    "name": file_name,
-                    "original_path": file_path,
-                    "id": file_result.get("_id"),
-                    "size": file_result.get("size", len(file_data))
-                })
-                
-            except Exception as e:
-                logger.error(f"Failed to extract/upload {file_path} from ZIP: {str(e)}")
-                # Continue with other files
-                continue
+        # Extract and upload the files concurrently
+        with zip_file, ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(
+                lambda info: _upload_zip_member(zip_file, info, folder_id),
+                file_list
+            ))
+        uploaded_files = [result for result in results if result is not None]
         
-        zip_file.close()
         logger.info(f"Successfully extracted and uploaded {len(uploaded_files)} file(s) from ZIP")
         
         return uploaded_files
@@ -544,25 +1107,26 @@ def set_folder_access(folder_id, public=True, access_list=None):
         GirderError: If API request fails
     """
     try:
-        logger.info(f"Setting folder access for {folder_id} (public={public})")
+        logger.debug("Setting folder access for %s (public=%s)", folder_id, public)
         params = {
             "public": str(public).lower(),
             "recurse": "false"  # Don't apply to subfolders by default
         }
         
-        data = {}
+        headers, data = _auth_headers(), None
         if access_list:
-            data["access"] = access_list
+            headers, data = _json_request({"access": access_list})
         
-        r = requests.put(
+        r = _session.put(
             f"{GIRDER_API_URL}/folder/{folder_id}/access",
-            headers=HEADERS,
+            headers=headers,
             params=params,
-            json=data if data else None
+            data=data
         )
         r.raise_for_status()
-        folder = r.json()
-        logger.info(f"Successfully set folder access for {folder_id}")
+        folder = _response_json(r)
+        _cache_put(_folder_by_id_cache, folder_id, folder, FOLDER_CACHE_TTL)
+        logger.debug("Successfully set folder access for %s", folder_id)
         return folder
     except requests.exceptions.RequestException as e:
         logger.error(f"Error setting folder access for {folder_id}: {str(e)}")
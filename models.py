@@ -1,4 +1,9 @@
-from pydantic import BaseModel
+from typing import List
+
+from pydantic import BaseModel, Field
+
+# Most patients accepted in one batch webhook request
+MAX_BATCH_PATIENTS = 500
 
 class Patient(BaseModel):
     center_code: str
@@ -6,3 +11,6 @@ class Patient(BaseModel):
     age: int
     sex: str
 
+
+class PatientBatch(BaseModel):
+    patients: List[Patient] = Field(max_length=MAX_BATCH_PATIENTS)
@@ -60,10 +60,12 @@ from database import Database
 from girder_client import (
     get_or_create_folder,
     find_folder,
+    list_children,
     GirderError
 )
 import logging
-import sqlite3
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
 # Configure logging to see what's happening
 logging.basicConfig(
@@ -73,10 +75,48 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
+# Girder requests creating sibling folders at the same time
+SCHEMA_WORKERS = 16
+
+
+def _ensure_folders(executor: ThreadPoolExecutor, jobs: list, list_subfolders: bool = True) -> list:
+    """
+    Create or find sibling folders in Girder at the same time.
+    
+    Args:
+        executor: Thread pool running the Girder requests
+        jobs: List of (item, folder name, parent folder ID) tuples
+        list_subfolders: Also list each folder's existing subfolders, so the
+            next level finds them without one lookup per name
+        
+    Returns:
+        List of (item, folder ID, error) tuples in the order of jobs, where
+        the folder ID is None and error the GirderError if the folder failed
+    """
+    def ensure(name, parent_id):
+        folder_id = get_or_create_folder(name=name, parent_id=parent_id, public=True)['_id']
+        if list_subfolders:
+            list_children(folder_id)
+        return folder_id
+    
+    futures = [(item, executor.submit(ensure, name, parent_id)) for item, name, parent_id in jobs]
+    results = []
+    for item, future in futures:
+        try:
+            results.append((item, future.result(), None))
+        except GirderError as e:
+            results.append((item, None, e))
+    return results
+
+
 def create_girder_schema(root_folder_id: str):
     """
     Main function that creates the complete Girder schema.
     
+    Centers are processed one at a time; within a center, the folders of
+    each level (patients, then visits, then document types) are created
+    in parallel.
+    
     Args:
         root_folder_id: The ID of the root folder in Girder where we'll create everything
     """
@@ -95,142 +135,100 @@ def create_girder_schema(root_folder_id: str):
     
     logger.info(f"Found {len(structure)} centers in database")
     
-    # Step 3: Process each center (hospital)
-    for center in structure:
-        center_code = center['code']  # e.g., "Bordeaux"
-        center_name = center['name']   # e.g., "CHU Bordeaux"
-        center_girder_name = f"CHU_{center_code}"  # e.g., "CHU_Bordeaux"
-        
-        logger.info(f"\n🏥 Processing Center: {center_name} ({center_code})")
-        
-        # Step 3a: Create or find the center folder in Girder
-        # This creates a folder like "CHU_Bordeaux" under the root folder
-        try:
-            center_folder = get_or_create_folder(
-                name=center_girder_name,
-                parent_id=root_folder_id,
-                public=True
-            )
-            center_girder_id = center_folder['_id']
-            logger.info(f"   ✅ Center folder '{center_girder_name}' ready (ID: {center_girder_id[:8]}...)")
-            
-            # Step 3b: Update database with Girder folder ID (if not already set)
-            # This stores the Girder folder ID so we know it's synced
-            if not center.get('girder_folder_id'):
-                conn_db = sqlite3.connect(db.db_path)
-                cursor = conn_db.cursor()
-                cursor.execute(
-                    "UPDATE centers SET girder_folder_id = ? WHERE id = ?",
-                    (center_girder_id, center['id'])
-                )
-                conn_db.commit()
-                conn_db.close()
-                logger.info(f"   💾 Saved Girder folder ID to database")
+    # List each parent's existing subfolders with one request, so that
+    # get_or_create_folder finds them without one lookup per name
+    list_children(root_folder_id)
+    
+    with ThreadPoolExecutor(max_workers=SCHEMA_WORKERS) as executor:
+        # Step 3: Process each center (hospital)
+        for center in structure:
+            center_code = center['code']  # e.g., "Bordeaux"
+            center_name = center['name']   # e.g., "CHU Bordeaux"
+            center_girder_name = f"CHU_{center_code}"  # e.g., "CHU_Bordeaux"
             
-        except GirderError as e:
-            logger.error(f"   ❌ Failed to create center folder: {str(e)}")
-            continue  # Skip this center if we can't create it
-        
-        # Step 4: Process each patient under this center
-        for patient in center.get('patients', []):
-            patient_id = patient['patient_id']  # e.g., "Patient_001"
+            logger.info(f"\n🏥 Processing Center: {center_name} ({center_code})")
             
-            logger.info(f"\n   👤 Processing Patient: {patient_id}")
+            # Girder folder IDs to record for this center's rows, by table. They
+            # are saved together in one transaction once the center is done.
+            folder_ids = defaultdict(list)
             
-            # Step 4a: Create or find the patient folder in Girder
-            # This creates a folder like "Patient_001" under "CHU_Bordeaux"
+            # Step 3a: Create or find the center folder in Girder
+            # This creates a folder like "CHU_Bordeaux" under the root folder
             try:
-                patient_folder = get_or_create_folder(
-                    name=patient_id,
-                    parent_id=center_girder_id,
+                center_folder = get_or_create_folder(
+                    name=center_girder_name,
+                    parent_id=root_folder_id,
                     public=True
                 )
-                patient_girder_id = patient_folder['_id']
-                logger.info(f"      ✅ Patient folder '{patient_id}' ready (ID: {patient_girder_id[:8]}...)")
+                center_girder_id = center_folder['_id']
+                list_children(center_girder_id)
+                logger.info("   ✅ Center folder '%s' ready (ID: %.8s...)", center_girder_name, center_girder_id)
                 
-                # Step 4b: Update database with Girder folder ID
-                if not patient.get('girder_folder_id'):
-                    conn_db = sqlite3.connect(db.db_path)
-                    cursor = conn_db.cursor()
-                    cursor.execute(
-                        "UPDATE patients SET girder_folder_id = ? WHERE id = ?",
-                        (patient_girder_id, patient['id'])
-                    )
-                    conn_db.commit()
-                    conn_db.close()
-                    logger.info(f"      💾 Saved Girder folder ID to database")
+                # Step 3b: Queue the Girder folder ID for the database (if not already set)
+                # This stores the Girder folder ID so we know it's synced
+                if not center.get('girder_folder_id'):
+                    folder_ids["centers"].append((center['id'], center_girder_id))
                 
             except GirderError as e:
-                logger.error(f"      ❌ Failed to create patient folder: {str(e)}")
-                continue  # Skip this patient if we can't create it
+                logger.error(f"   ❌ Failed to create center folder: {str(e)}")
+                continue  # Skip this center if we can't create it
             
-            # Step 5: Process each visit under this patient
-            for visit in patient.get('visits', []):
-                visit_name = visit['visit_name']  # e.g., "Inclusion M0"
-                visit_code = visit['visit_code']  # e.g., "M0"
-                
-                logger.info(f"\n      📅 Processing Visit: {visit_name} ({visit_code})")
+            # Step 4: Create or find all patient folders of this center in parallel
+            # This creates folders like "Patient_001" under "CHU_Bordeaux"
+            patients = []
+            for patient, patient_girder_id, error in _ensure_folders(executor, [
+                (patient, patient['patient_id'], center_girder_id)
+                for patient in center.get('patients', [])
+            ]):
+                patient_id = patient['patient_id']  # e.g., "Patient_001"
+                if error:
+                    logger.error(f"      ❌ Failed to create patient folder '{patient_id}': {str(error)}")
+                    continue  # Skip this patient if we can't create it
                 
-                # Step 5a: Create or find the visit folder in Girder
-                # This creates a folder like "Inclusion M0" under "Patient_001"
-                try:
-                    visit_folder = get_or_create_folder(
-                        name=visit_name,
-                        parent_id=patient_girder_id,
-                        public=True
-                    )
-                    visit_girder_id = visit_folder['_id']
-                    logger.info(f"         ✅ Visit folder '{visit_name}' ready (ID: {visit_girder_id[:8]}...)")
-                    
-                    # Step 5b: Update database with Girder folder ID
-                    if not visit.get('girder_folder_id'):
-                        conn_db = sqlite3.connect(db.db_path)
-                        cursor = conn_db.cursor()
-                        cursor.execute(
-                            "UPDATE visits SET girder_folder_id = ? WHERE id = ?",
-                            (visit_girder_id, visit['id'])
-                        )
-                        conn_db.commit()
-                        conn_db.close()
-                        logger.info(f"         💾 Saved Girder folder ID to database")
-                    
-                except GirderError as e:
-                    logger.error(f"         ❌ Failed to create visit folder: {str(e)}")
+                logger.info("      ✅ Patient folder '%s' ready (ID: %.8s...)", patient_id, patient_girder_id)
+                if not patient.get('girder_folder_id'):
+                    folder_ids["patients"].append((patient['id'], patient_girder_id))
+                patients.append((patient, patient_girder_id))
+            
+            # Step 5: Create or find the visit folders of all these patients in parallel
+            # This creates folders like "Inclusion M0" under "Patient_001"
+            visits = []
+            for (patient_id, visit), visit_girder_id, error in _ensure_folders(executor, [
+                ((patient['patient_id'], visit), visit['visit_name'], patient_girder_id)
+                for patient, patient_girder_id in patients
+                for visit in patient.get('visits', [])
+            ]):
+                visit_path = f"{patient_id}/{visit['visit_name']}"  # e.g., "Patient_001/Inclusion M0"
+                if error:
+                    logger.error(f"         ❌ Failed to create visit folder '{visit_path}': {str(error)}")
                     continue  # Skip this visit if we can't create it
                 
-                # Step 6: Process each document type under this visit
-                for doc_type in visit.get('document_types', []):
-                    doc_name = doc_type['document_name']  # e.g., "Bilan Biologique"
-                    doc_code = doc_type['document_code']  # e.g., "bilan_biologique"
-                    
-                    logger.info(f"            📄 Processing Document Type: {doc_name}")
-                    
-                    # Step 6a: Create or find the document type folder in Girder
-                    # This creates a folder like "Bilan Biologique" under "Inclusion M0"
-                    try:
-                        doc_folder = get_or_create_folder(
-                            name=doc_name,
-                            parent_id=visit_girder_id,
-                            public=True
-                        )
-                        doc_girder_id = doc_folder['_id']
-                        logger.info(f"               ✅ Document folder '{doc_name}' ready (ID: {doc_girder_id[:8]}...)")
-                        
-                        # Step 6b: Update database with Girder folder ID
-                        if not doc_type.get('girder_folder_id'):
-                            conn_db = sqlite3.connect(db.db_path)
-                            cursor = conn_db.cursor()
-                            cursor.execute(
-                                "UPDATE document_types SET girder_folder_id = ? WHERE id = ?",
-                                (doc_girder_id, doc_type['id'])
-                            )
-                            conn_db.commit()
-                            conn_db.close()
-                            logger.info(f"               💾 Saved Girder folder ID to database")
-                        
-                    except GirderError as e:
-                        logger.error(f"               ❌ Failed to create document folder: {str(e)}")
-                        continue  # Skip this document type if we can't create it
+                logger.info("         ✅ Visit folder '%s' ready (ID: %.8s...)", visit_path, visit_girder_id)
+                if not visit.get('girder_folder_id'):
+                    folder_ids["visits"].append((visit['id'], visit_girder_id))
+                visits.append((visit_path, visit, visit_girder_id))
+            
+            # Step 6: Create or find the document type folders of all these visits in parallel
+            # This creates folders like "Bilan Biologique" under "Inclusion M0"
+            for (visit_path, doc_type), doc_girder_id, error in _ensure_folders(executor, [
+                ((visit_path, doc_type), doc_type['document_name'], visit_girder_id)
+                for visit_path, visit, visit_girder_id in visits
+                for doc_type in visit.get('document_types', [])
+            ], list_subfolders=False):
+                doc_path = f"{visit_path}/{doc_type['document_name']}"
+                if error:
+                    logger.error(f"            ❌ Failed to create document folder '{doc_path}': {str(error)}")
+                    continue  # Skip this document type if we can't create it
+                
+                logger.info("            ✅ Document folder '%s' ready (ID: %.8s...)", doc_path, doc_girder_id)
+                if not doc_type.get('girder_folder_id'):
+                    folder_ids["document_types"].append((doc_type['id'], doc_girder_id))
+            
+            # Step 7: Save the center's new Girder folder IDs in one transaction
+            if folder_ids:
+                db.set_girder_folder_ids(folder_ids)
+                saved = sum(len(rows) for rows in folder_ids.values())
+                logger.info(f"   💾 Saved {saved} Girder folder IDs to database")
     
     logger.info("\n" + "=" * 60)
     logger.info("✅ Schema creation completed!")
@@ -0,0 +1,251 @@
+"""
+Local storage for uploaded files.
+
+Uploads are appended to one tar shard per document type
+(uploads/{center}/{patient}/{visit}/{doc}.tar) instead of being written as
+one file each. The database records the shard path and the offset of the
+member's data, so a file can be read back with a single seek. Members are
+gzip-compressed unless their format is already compressed.
+
+Rows created before sharding have no data_offset and point at a loose file.
+"""
+
+import gzip
+import io
+import os
+import shutil
+import tarfile
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import BinaryIO, Dict, Iterator, Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows: only in-process locking is available
+    fcntl = None
+
+SHARD_SUFFIX = ".tar"
+
+# Buffer size used when copying uploads into a shard
+WRITE_BUFFER_SIZE = 1 << 20  # 1 MB
+
+# Fast compression: the goal is fewer bytes on disk and to sync, not the best ratio
+GZIP_COMPRESSLEVEL = 1
+
+# Compressed data larger than this is spooled to a temporary file
+SPOOL_MAX_SIZE = 8 * 1024 * 1024
+
+# Formats that are already compressed and are stored as-is
+COMPRESSED_MIME_TYPES = frozenset({
+    "application/gzip",
+    "application/x-gzip",
+    "application/zip",
+    "application/x-zip-compressed",
+    "application/x-7z-compressed",
+    "application/x-bzip2",
+    "application/x-xz",
+    "application/pdf",
+    "image/jpeg",
+    "image/png",
+    "image/gif",
+    "image/webp",
+})
+COMPRESSED_MIME_PREFIXES = ("video/", "audio/")
+
+_shard_locks: Dict[Path, threading.Lock] = {}
+_shard_locks_guard = threading.Lock()
+
+
+def shard_path(uploads_dir: Path, center_code: str, patient_id: str,
+               visit_code: str, document_code: str) -> Path:
+    """Get the tar shard holding the files of a document type"""
+    return uploads_dir / center_code / patient_id / visit_code / f"{document_code}{SHARD_SUFFIX}"
+
+
+@contextmanager
+def _locked_shard(shard: Path):
+    """
+    Open a shard for appending, holding its lock for the duration.
+
+    A per-shard thread lock serializes writers within this process and an
+    flock on the file serializes writers across worker processes.
+    """
+    with _shard_locks_guard:
+        lock = _shard_locks.setdefault(shard, threading.Lock())
+
+    with lock:
+        # Not 'a+b': appending overwrites the end-of-archive blocks
+        try:
+            fd = os.open(shard, os.O_RDWR | os.O_CREAT, 0o644)
+        except FileNotFoundError:
+            # First upload for this visit: create the directories only now,
+            # so warm uploads don't pay for a mkdir/stat per path component
+            shard.parent.mkdir(parents=True, exist_ok=True)
+            fd = os.open(shard, os.O_RDWR | os.O_CREAT, 0o644)
+        with open(fd, 'r+b') as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield f
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _is_compressed(mime_type: str) -> bool:
+    """Whether a MIME type is already compressed, so gzip would only cost CPU"""
+    return mime_type in COMPRESSED_MIME_TYPES or mime_type.startswith(COMPRESSED_MIME_PREFIXES)
+
+
+def _compress(src: BinaryIO) -> BinaryIO:
+    """Gzip `src` into a spooled temporary file, returned positioned at its end"""
+    compressed = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    with gzip.GzipFile(fileobj=compressed, mode='wb', compresslevel=GZIP_COMPRESSLEVEL, mtime=0) as gz:
+        shutil.copyfileobj(src, gz, WRITE_BUFFER_SIZE)
+    return compressed
+
+
+def _archive_end(f: BinaryIO) -> int:
+    """Offset of a shard's end-of-archive marker, where the next member is written"""
+    size = f.seek(0, 2)
+    if not size:
+        return 0
+    if size % tarfile.RECORDSIZE:
+        # Written by _append_member, which ends the archive with exactly two zero blocks
+        return size - 2 * tarfile.BLOCKSIZE
+    # Padded to a full record (as tarfile does, or by chance): find the end
+    # from the member headers
+    f.seek(0)
+    with tarfile.open(fileobj=f, mode='r') as tar:
+        tar.getmembers()
+        return tar.offset
+
+
+def _append_member(shard: Path, info: tarfile.TarInfo, src: BinaryIO) -> int:
+    """
+    Append `info.size` bytes of `src` to a shard and return the data offset.
+
+    The member is written in place of the end-of-archive marker, followed
+    by a new one, so appending never reads the members already in the shard.
+    """
+    header = info.tobuf(tarfile.DEFAULT_FORMAT, tarfile.ENCODING, 'surrogateescape')
+    with _locked_shard(shard) as f:
+        append_at = _archive_end(f)
+        f.seek(append_at)
+        try:
+            f.write(header)
+            remaining = info.size
+            while remaining:
+                chunk = src.read(min(remaining, WRITE_BUFFER_SIZE))
+                if not chunk:
+                    raise OSError(f"{info.name}: unexpected end of data")
+                f.write(chunk)
+                remaining -= len(chunk)
+            f.write(tarfile.NUL * (-info.size % tarfile.BLOCKSIZE))
+        except BaseException:
+            # Drop the partial member so the shard stays readable
+            f.seek(append_at)
+            raise
+        finally:
+            f.write(tarfile.NUL * (2 * tarfile.BLOCKSIZE))
+            f.truncate()
+
+    return append_at + len(header)
+
+
+def store_upload(shard: Path, member_name: str, src: BinaryIO, mime_type: str,
+                 size: Optional[int] = None) -> Dict:
+    """
+    Append the whole contents of `src` to a shard as a new member (blocking, run in a worker thread).
+
+    The data is gzip-compressed first unless its MIME type is already
+    compressed or compression does not make it smaller. Compression happens
+    before the shard lock is taken.
+
+    Args:
+        shard: Path of the tar shard (created if missing)
+        member_name: Name of the member inside the archive
+        src: Seekable binary file object
+        mime_type: MIME type of the upload
+        size: Size of `src` in bytes if already known (detected by seeking if omitted)
+
+    Returns:
+        Dict with data_offset, file_size, stored_size and stored_encoding,
+        matching the columns of the files table
+    """
+    file_size = src.seek(0, 2) if size is None else size
+    src.seek(0)
+
+    data, stored_size, stored_encoding = src, file_size, None
+    if file_size and not _is_compressed(mime_type):
+        compressed = _compress(src)
+        compressed_size = compressed.tell()
+        if compressed_size < file_size:
+            compressed.seek(0)
+            data, stored_size, stored_encoding = compressed, compressed_size, 'gzip'
+        else:
+            compressed.close()
+            src.seek(0)
+
+    info = tarfile.TarInfo(member_name)
+    info.size = stored_size
+    info.mtime = int(time.time())
+
+    try:
+        data_offset = _append_member(shard, info, data)
+    finally:
+        if data is not src:
+            data.close()
+
+    return {
+        'data_offset': data_offset,
+        'file_size': file_size,
+        'stored_size': stored_size,
+        'stored_encoding': stored_encoding
+    }
+
+
+class _MemberReader(io.RawIOBase):
+    """Read-only view of the next `size` bytes of a file"""
+
+    def __init__(self, f: BinaryIO, size: int):
+        self._f = f
+        self._remaining = size
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        n = min(len(b), self._remaining)
+        if n <= 0:
+            return 0
+        n = self._f.readinto(memoryview(b)[:n])
+        self._remaining -= n
+        return n
+
+
+@contextmanager
+def open_stored_file(file_info: Dict) -> Iterator[BinaryIO]:
+    """
+    Open a stored file for reading its original contents.
+
+    Read exactly `file_size` bytes from the yielded object; for sharded
+    files the following bytes belong to the archive, not to the file.
+    Compressed members are decompressed on the fly.
+
+    Args:
+        file_info: Row of the files table (file_path, data_offset, stored_size,
+            stored_encoding); legacy rows point at a loose file
+    """
+    with open(file_info['file_path'], 'rb') as f:
+        if file_info.get('data_offset'):
+            f.seek(file_info['data_offset'])
+        if file_info.get('stored_encoding') == 'gzip':
+            member = io.BufferedReader(_MemberReader(f, file_info['stored_size']), WRITE_BUFFER_SIZE)
+            with gzip.GzipFile(fileobj=member, mode='rb') as gz:
+                yield gz
+        else:
+            yield f
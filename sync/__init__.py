@@ -2,6 +2,6 @@
 Sync module for extracting data from REDCap mimic and syncing to Girder.
 """
 
-from .extract_sync import extract_and_sync_files, get_unsynced_files_count
+from .extract_sync import extract_and_sync_files, get_unsynced_files_count, has_unsynced_files
 
-__all__ = ['extract_and_sync_files', 'get_unsynced_files_count']
+__all__ = ['extract_and_sync_files', 'get_unsynced_files_count', 'has_unsynced_files']
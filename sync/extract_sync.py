@@ -11,8 +11,8 @@ WHAT THIS MODULE DOES:
 
 2. SYNC PHASE:
    - For each unsynced file:
-     a. Validates folder structure exists in Girder
-     b. Finds the correct Girder folder path
+     a. Uses the folder IDs stored in the database, without verifying them
+     b. Finds the correct Girder folder path (once per document type folder)
      c. Uploads the file to Girder
      d. Marks file as synced in database
 
@@ -40,17 +40,19 @@ This module is the "mimic" version - it reads from SQLite instead of REDCap API.
 
 import sys
 import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import List, Dict, Optional, Tuple
+from typing import Dict, Iterator, Optional, Tuple
 import logging
 
 # Add parent directory to path so we can import our modules
 sys.path.insert(0, str(Path(__file__).parent.parent))
 
 from database import Database
+from storage import open_stored_file
 from girder_client import (
-    find_folder,
-    get_folder_by_id,
+    list_children,
     upload_file,
     GirderError
 )
@@ -62,68 +64,118 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Synced files marked in the database per transaction
+MARK_SYNCED_BATCH_SIZE = 500
 
-def get_unsynced_files(db: Database) -> List[Dict]:
+# Files uploaded to Girder at the same time
+SYNC_UPLOAD_WORKERS = 8
+
+# Uploads submitted but not yet collected; reading further files waits
+# for the oldest upload once this many are pending
+SYNC_MAX_PENDING = 2 * SYNC_UPLOAD_WORKERS
+
+# Unsynced files read from the database per query
+UNSYNCED_FILES_PAGE_SIZE = 500
+
+# Queries run on the database's pooled connections. As fixed strings they are
+# prepared once per connection and reused from its statement cache.
+# Unsynced files are read a page at a time, after the (uploaded_at, id) of
+# the previous page's last row.
+_SQL_UNSYNCED_FILES = """
+    SELECT f.id, f.uploaded_at, f.filename, f.file_path, f.file_size, f.document_type_id,
+           f.data_offset, f.stored_size, f.stored_encoding,
+           dt.document_name, dt.girder_folder_id as doc_girder_folder_id,
+           v.visit_name, v.girder_folder_id as visit_girder_folder_id,
+           p.patient_id, p.girder_folder_id as patient_girder_folder_id,
+           c.code as center_code, c.girder_folder_id as center_girder_folder_id
+    FROM files f
+    JOIN document_types dt ON f.document_type_id = dt.id
+    JOIN visits v ON dt.visit_id = v.id
+    JOIN patients p ON v.patient_id = p.id
+    JOIN centers c ON p.center_id = c.id
+    WHERE f.synced_to_girder = 0 AND (f.uploaded_at, f.id) > (?, ?)
+    ORDER BY f.uploaded_at ASC, f.id ASC
+    LIMIT ?
+"""
+
+_SQL_COUNT_UNSYNCED_FILES = "SELECT COUNT(*) FROM files WHERE synced_to_girder = 0"
+
+# Stops at the first entry of idx_files_unsynced instead of counting them all
+_SQL_HAS_UNSYNCED_FILES = "SELECT EXISTS (SELECT 1 FROM files WHERE synced_to_girder = 0)"
+
+
+def count_unsynced_files(db: Database) -> int:
+    """Number of files where synced_to_girder = 0"""
+    with db.acquire_readonly() as conn:
+        return conn.execute(_SQL_COUNT_UNSYNCED_FILES).fetchone()[0]
+
+
+def get_unsynced_files(db: Database) -> Iterator[Dict]:
     """
     Extract all unsynced files from the database.
     
     WHAT IT DOES:
     - Queries SQLite database for files where synced_to_girder = 0
     - Gets full path information (center, patient, visit, document type)
-    - Returns list of file dictionaries with all metadata
+    - Yields file dictionaries with all metadata, one row at a time
+    
+    Rows are read UNSYNCED_FILES_PAGE_SIZE at a time, and the read-only
+    connection is only borrowed while a page is fetched.
     
     Args:
         db: Database instance
         
-    Returns:
-        List of file dictionaries with path information
+    Yields:
+        File dictionaries with path information, oldest upload first
     """
-    logger.info("📖 Extracting unsynced files from database...")
-    
-    # Query database for all files that haven't been synced
-    import sqlite3
-    conn = sqlite3.connect(db.db_path)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    
-    # Get all unsynced files with full path information
-    cursor.execute("""
-        SELECT f.*, 
-               dt.document_name, dt.document_code, dt.girder_folder_id as doc_girder_folder_id,
-               v.visit_name, v.visit_code, v.girder_folder_id as visit_girder_folder_id,
-               p.patient_id, p.girder_folder_id as patient_girder_folder_id,
-               c.code as center_code, c.name as center_name, c.girder_folder_id as center_girder_folder_id
-        FROM files f
-        JOIN document_types dt ON f.document_type_id = dt.id
-        JOIN visits v ON dt.visit_id = v.id
-        JOIN patients p ON v.patient_id = p.id
-        JOIN centers c ON p.center_id = c.id
-        WHERE f.synced_to_girder = 0
-        ORDER BY f.uploaded_at ASC
-    """)
-    
-    files = [dict(row) for row in cursor.fetchall()]
-    conn.close()
-    
-    logger.info(f"   Found {len(files)} unsynced file(s)")
-    return files
+    # Get all unsynced files with the path information the sync uses, on the
+    # database's pooled read-only connections
+    after = ("", 0)
+    while True:
+        with db.acquire_readonly() as conn:
+            rows = conn.execute(_SQL_UNSYNCED_FILES, (*after, UNSYNCED_FILES_PAGE_SIZE)).fetchall()
+        for row in rows:
+            yield dict(row)
+        if len(rows) < UNSYNCED_FILES_PAGE_SIZE:
+            return
+        after = (rows[-1]['uploaded_at'], rows[-1]['id'])
+
+
+# Girder folder tree of the current sync run, as {parent ID: {name: child ID}}.
+# Each parent's subfolders are listed once, the first time a path through it
+# has to be found by name; paths with stored folder IDs are never listed.
+_folder_tree: Dict[str, Dict[str, str]] = {}
+
+
+def _find_folder_id(name: str, parent_id: str) -> Optional[str]:
+    """ID of the folder `name` in `parent_id` from the run's folder tree, listing the parent on first use"""
+    children = _folder_tree.get(parent_id)
+    if children is None:
+        children = {child: folder['_id'] for child, folder in list_children(parent_id).items()}
+        _folder_tree[parent_id] = children
+    return children.get(name)
 
 
 def find_girder_folder_path(
     file_info: Dict,
-    root_folder_id: str
+    root_folder_id: str,
+    use_stored_ids: bool = True
 ) -> Tuple[str, str]:
     """
     Find the correct Girder folder path for a file.
     
     WHAT IT DOES:
     - Takes file information (center, patient, visit, document)
-    - Traverses Girder folder structure to find the document type folder
+    - Uses the folder IDs stored in the database as they are, without
+      asking Girder whether they still exist
+    - Traverses Girder folder structure to find the folders with no stored ID
     - Returns the folder ID where the file should be uploaded
     
     Args:
         file_info: Dictionary with file and path information
         root_folder_id: Root folder ID in Girder
+        use_stored_ids: False to ignore the stored IDs and find every folder
+            by name, e.g. after an upload into a stored folder failed
         
     Returns:
         Tuple of (folder_id, folder_path_string)
@@ -132,116 +184,102 @@ def find_girder_folder_path(
         ValueError: If folder structure doesn't exist in Girder
     """
     center_code = file_info['center_code']
-    center_name = file_info['center_name']
     patient_id = file_info['patient_id']
     visit_name = file_info['visit_name']
     document_name = file_info['document_name']
     
     center_girder_name = f"CHU_{center_code}"
     
+    # Build folder path string for logging
+    folder_path = f"{center_girder_name}/{patient_id}/{visit_name}/{document_name}"
+    
+    # Folder IDs stored in the database, trusted without a round trip to Girder
+    stored_ids = file_info if use_stored_ids else {}
+    if stored_ids.get('doc_girder_folder_id'):
+        return stored_ids['doc_girder_folder_id'], folder_path
+    
     # Step 1: Find Center folder
     # First check if we have the folder ID stored in database
-    center_folder_id = file_info.get('center_girder_folder_id')
-    
-    if center_folder_id:
-        # Verify folder still exists
-        try:
-            get_folder_by_id(center_folder_id)
-        except GirderError:
-            # Folder doesn't exist, need to find it
-            center_folder_id = None
+    center_folder_id = stored_ids.get('center_girder_folder_id')
     
     if not center_folder_id:
         # Find center folder by name
-        center_folder = find_folder(center_girder_name, root_folder_id)
-        if not center_folder:
+        center_folder_id = _find_folder_id(center_girder_name, root_folder_id)
+        if not center_folder_id:
             raise ValueError(
                 f"Center '{center_girder_name}' not found in Girder. "
                 f"Please run create_girder_schema.py first."
             )
-        center_folder_id = center_folder['_id']
     
     # Step 2: Find Patient folder
-    patient_folder_id = file_info.get('patient_girder_folder_id')
-    
-    if patient_folder_id:
-        try:
-            get_folder_by_id(patient_folder_id)
-        except GirderError:
-            patient_folder_id = None
+    patient_folder_id = stored_ids.get('patient_girder_folder_id')
     
     if not patient_folder_id:
-        patient_folder = find_folder(patient_id, center_folder_id)
-        if not patient_folder:
+        patient_folder_id = _find_folder_id(patient_id, center_folder_id)
+        if not patient_folder_id:
             raise ValueError(
                 f"Patient '{patient_id}' not found in Girder under '{center_girder_name}'. "
                 f"Please run create_girder_schema.py first."
             )
-        patient_folder_id = patient_folder['_id']
     
     # Step 3: Find Visit folder
-    visit_folder_id = file_info.get('visit_girder_folder_id')
-    
-    if visit_folder_id:
-        try:
-            get_folder_by_id(visit_folder_id)
-        except GirderError:
-            visit_folder_id = None
+    visit_folder_id = stored_ids.get('visit_girder_folder_id')
     
     if not visit_folder_id:
-        visit_folder = find_folder(visit_name, patient_folder_id)
-        if not visit_folder:
+        visit_folder_id = _find_folder_id(visit_name, patient_folder_id)
+        if not visit_folder_id:
             raise ValueError(
                 f"Visit '{visit_name}' not found in Girder under patient '{patient_id}'. "
                 f"Please run create_girder_schema.py first."
             )
-        visit_folder_id = visit_folder['_id']
     
     # Step 4: Find Document Type folder (this is where we upload the file)
-    doc_folder_id = file_info.get('doc_girder_folder_id')
-    
-    if doc_folder_id:
-        try:
-            get_folder_by_id(doc_folder_id)
-        except GirderError:
-            doc_folder_id = None
-    
+    doc_folder_id = _find_folder_id(document_name, visit_folder_id)
     if not doc_folder_id:
-        doc_folder = find_folder(document_name, visit_folder_id)
-        if not doc_folder:
-            raise ValueError(
-                f"Document type '{document_name}' not found in Girder under visit '{visit_name}'. "
-                f"Please run create_girder_schema.py first."
-            )
-        doc_folder_id = doc_folder['_id']
-    
-    # Build folder path string for logging
-    folder_path = f"{center_girder_name}/{patient_id}/{visit_name}/{document_name}"
+        raise ValueError(
+            f"Document type '{document_name}' not found in Girder under visit '{visit_name}'. "
+            f"Please run create_girder_schema.py first."
+        )
     
     return doc_folder_id, folder_path
 
 
+def _upload_stored_file(file_info: Dict, girder_folder_id: str) -> str:
+    """Upload a stored file into a Girder folder, streaming it from disk; returns the Girder file ID"""
+    with open_stored_file(file_info) as f:
+        girder_file = upload_file(f, girder_folder_id, file_info['filename'], size=file_info['file_size'])
+    return girder_file['_id']
+
+
 def sync_single_file(
     file_info: Dict,
-    root_folder_id: str,
-    db: Database
-) -> Tuple[bool, str, Optional[str]]:
+    girder_folder_id: str,
+    folder_path: str,
+    root_folder_id: Optional[str] = None
+) -> Tuple[bool, str, Optional[str], Optional[str]]:
     """
     Sync a single file to Girder.
     
     WHAT IT DOES:
     1. Validates file exists on disk
-    2. Finds correct Girder folder path
-    3. Uploads file to Girder
-    4. Marks file as synced in database
+    2. Uploads file to its Girder folder
+    3. If that fails, finds the folder again by name and, if its ID changed,
+       uploads once more
+    
+    The caller marks the file as synced in the database.
     
     Args:
         file_info: Dictionary with file information
-        root_folder_id: Root folder ID in Girder
-        db: Database instance
+        girder_folder_id: ID of the document type folder to upload into,
+            from find_girder_folder_path
+        folder_path: Path of that folder, for logging
+        root_folder_id: Root folder ID in Girder, to find the folder by
+            name after a failed upload; no retry without it
         
     Returns:
-        Tuple of (success: bool, message: str, girder_file_id: Optional[str])
+        Tuple of (success: bool, message: str, girder_file_id: Optional[str],
+        new_folder_id: Optional[str]), where new_folder_id is the folder's
+        current ID if it was found again under a different one
     """
     file_id = file_info['id']
     filename = file_info['filename']
@@ -252,42 +290,41 @@ def sync_single_file(
         if not file_path.exists():
             error_msg = f"File not found on disk: {file_path}"
             logger.error(f"   ❌ File {file_id} ({filename}): {error_msg}")
-            return False, error_msg, None
-        
-        # Step 2: Find Girder folder path
-        try:
-            girder_folder_id, folder_path = find_girder_folder_path(file_info, root_folder_id)
-        except ValueError as e:
-            error_msg = str(e)
-            logger.error(f"   ❌ File {file_id} ({filename}): {error_msg}")
-            return False, error_msg, None
+            return False, error_msg, None, None
         
-        # Step 3: Read file from disk
-        logger.info(f"   📤 Uploading: {filename} → {folder_path}")
-        with open(file_path, 'rb') as f:
-            file_data = f.read()
-        
-        # Step 4: Upload to Girder
+        # Step 2: Upload to Girder, streaming the file from disk
+        logger.debug("   📤 Uploading: %s → %s", filename, folder_path)
+        new_folder_id = None
         try:
-            girder_file = upload_file(file_data, girder_folder_id, filename)
-            girder_file_id = girder_file['_id']
-            
-            # Step 5: Mark as synced in database
-            db.mark_file_synced(file_id, girder_file_id)
+            try:
+                girder_file_id = _upload_stored_file(file_info, girder_folder_id)
+            except GirderError as upload_error:
+                # Step 3: The stored folder ID may be stale (folder deleted or
+                # recreated in Girder), as it isn't verified before uploading
+                if root_folder_id is None:
+                    raise
+                try:
+                    current_folder_id, _ = find_girder_folder_path(file_info, root_folder_id, use_stored_ids=False)
+                except ValueError:
+                    raise upload_error
+                if current_folder_id == girder_folder_id:
+                    raise
+                logger.warning(f"   ⚠️  Folder {folder_path} has a new ID, retrying upload of {filename}")
+                new_folder_id = current_folder_id
+                girder_file_id = _upload_stored_file(file_info, current_folder_id)
             
-            success_msg = f"Successfully synced to {folder_path}"
-            logger.info(f"   ✅ File {file_id} ({filename}): {success_msg}")
-            return True, success_msg, girder_file_id
+            logger.info("   ✅ File %s (%s): Successfully synced to %s", file_id, filename, folder_path)
+            return True, f"Successfully synced to {folder_path}", girder_file_id, new_folder_id
             
         except GirderError as e:
             error_msg = f"Failed to upload to Girder: {str(e)}"
             logger.error(f"   ❌ File {file_id} ({filename}): {error_msg}")
-            return False, error_msg, None
+            return False, error_msg, None, new_folder_id
             
     except Exception as e:
         error_msg = f"Unexpected error: {str(e)}"
         logger.error(f"   ❌ File {file_id} ({filename}): {error_msg}", exc_info=True)
-        return False, error_msg, None
+        return False, error_msg, None, None
 
 
 def extract_and_sync_files(root_folder_id: str) -> Dict:
@@ -295,9 +332,11 @@ def extract_and_sync_files(root_folder_id: str) -> Dict:
     Main function: Extract all unsynced files and sync them to Girder.
     
     WHAT IT DOES:
-    1. Gets all unsynced files from database
-    2. For each file, syncs it to Girder
-    3. Returns summary of results
+    1. Streams the unsynced files from the database
+    2. Finds each document type folder in Girder once
+    3. Syncs the files to Girder, several at a time
+    4. Records the synced files, and folders found under a new ID, in the database, in batches
+    5. Returns summary of results
     
     Args:
         root_folder_id: Root folder ID in Girder
@@ -317,11 +356,23 @@ def extract_and_sync_files(root_folder_id: str) -> Dict:
     
     # Initialize database
     db = Database()
+    try:
+        return _sync_unsynced_files(db, root_folder_id)
+    finally:
+        db.close()
+
+
+def _sync_unsynced_files(db: Database, root_folder_id: str) -> Dict:
+    """Body of extract_and_sync_files, run on an open database"""
+    # Folders may have changed in Girder since the last run
+    _folder_tree.clear()
     
-    # Step 1: Extract unsynced files
-    unsynced_files = get_unsynced_files(db)
+    # Step 1: Count the unsynced files; they are streamed from the database below
+    logger.info("📖 Extracting unsynced files from database...")
+    unsynced_count = count_unsynced_files(db)
+    logger.info(f"   Found {unsynced_count} unsynced file(s)")
     
-    if not unsynced_files:
+    if not unsynced_count:
         logger.info("✅ No files to sync. All files are already synced!")
         return {
             "total_files": 0,
@@ -330,40 +381,104 @@ def extract_and_sync_files(root_folder_id: str) -> Dict:
             "details": []
         }
     
-    logger.info(f"\n🔄 Syncing {len(unsynced_files)} file(s)...")
+    logger.info(f"\n🔄 Syncing {unsynced_count} file(s)...")
     logger.info("-" * 60)
     
-    # Step 2: Sync each file
+    # Step 2: Sync the files into their folders, SYNC_UPLOAD_WORKERS at a
+    # time. Each document type folder is resolved in Girder the first time
+    # one of its files comes up, and uploads start while later rows are read.
     results = {
-        "total_files": len(unsynced_files),
+        "total_files": unsynced_count,
         "synced": 0,
         "failed": 0,
         "details": []
     }
     
-    for file_info in unsynced_files:
-        file_id = file_info['id']
-        filename = file_info['filename']
+    # Uploaded files not yet marked as synced, as (file_id, girder_file_id)
+    synced = []
+    # Document type folders found under a new ID and not yet recorded, as
+    # (document_type_id, girder_folder_id)
+    moved_folders = []
+    # (file_info, folder key, upload future, folder error) per file not yet
+    # collected, oldest first
+    pending = deque()
+    # (center, patient, visit, document) → (folder ID, folder path, error)
+    folders = {}
+    
+    def flush():
+        if synced:
+            db.mark_files_synced(synced)
+            synced.clear()
+        if moved_folders:
+            db.set_girder_folder_ids({"document_types": moved_folders})
+            moved_folders.clear()
+    
+    def collect_oldest():
+        # Results are collected on this thread so that database writes stay here
+        file_info, key, future, folder_error = pending.popleft()
+        if future is None:
+            success, message, girder_file_id, new_folder_id = False, folder_error, None, None
+        else:
+            success, message, girder_file_id, new_folder_id = future.result()
         
-        success, message, girder_file_id = sync_single_file(
-            file_info,
-            root_folder_id,
-            db
-        )
+        # Later files of the folder upload straight into its new ID
+        if new_folder_id and folders[key][0] != new_folder_id:
+            folders[key] = (new_folder_id, *folders[key][1:])
+            moved_folders.append((file_info['document_type_id'], new_folder_id))
         
         if success:
             results["synced"] += 1
+            synced.append((file_info['id'], girder_file_id))
+            if len(synced) >= MARK_SYNCED_BATCH_SIZE:
+                flush()
         else:
             results["failed"] += 1
         
         results["details"].append({
-            "file_id": file_id,
-            "filename": filename,
+            "file_id": file_info['id'],
+            "filename": file_info['filename'],
             "success": success,
             "message": message,
             "girder_file_id": girder_file_id
         })
     
+    with ThreadPoolExecutor(max_workers=SYNC_UPLOAD_WORKERS) as executor:
+        try:
+            for file_info in get_unsynced_files(db):
+                key = (file_info['center_code'], file_info['patient_id'],
+                       file_info['visit_name'], file_info['document_name'])
+                if key not in folders:
+                    try:
+                        folders[key] = (*find_girder_folder_path(file_info, root_folder_id), None)
+                    except ValueError as e:
+                        folders[key] = (None, None, str(e))
+                        logger.error(f"   ❌ {str(e)}")
+                    except Exception as e:
+                        folders[key] = (None, None, f"Unexpected error: {str(e)}")
+                        logger.error(f"   ❌ Unexpected error: {str(e)}", exc_info=True)
+                girder_folder_id, folder_path, folder_error = folders[key]
+                
+                if folder_error:
+                    pending.append((file_info, key, None, folder_error))
+                else:
+                    future = executor.submit(
+                        sync_single_file, file_info, girder_folder_id, folder_path, root_folder_id
+                    )
+                    pending.append((file_info, key, future, None))
+                
+                # Keep a bounded number of files in flight
+                if len(pending) >= SYNC_MAX_PENDING:
+                    collect_oldest()
+            
+            while pending:
+                collect_oldest()
+        finally:
+            # Record what was uploaded even if the run stops early
+            flush()
+    
+    # Files may have been added or synced since they were counted
+    results["total_files"] = results["synced"] + results["failed"]
+    
     # Step 3: Print summary
     logger.info("\n" + "=" * 60)
     logger.info("Sync Summary")
@@ -376,7 +491,7 @@ def extract_and_sync_files(root_folder_id: str) -> Dict:
         logger.info("\nFailed files:")
         for detail in results['details']:
             if not detail['success']:
-                logger.info(f"  - {detail['filename']}: {detail['message']}")
+                logger.info("  - %s: %s", detail['filename'], detail['message'])
     
     logger.info("=" * 60)
     
@@ -391,13 +506,26 @@ def get_unsynced_files_count() -> int:
         Number of unsynced files
     """
     db = Database()
-    import sqlite3
-    conn = sqlite3.connect(db.db_path)
-    cursor = conn.cursor()
-    cursor.execute("SELECT COUNT(*) FROM files WHERE synced_to_girder = 0")
-    count = cursor.fetchone()[0]
-    conn.close()
-    return count
+    try:
+        return count_unsynced_files(db)
+    finally:
+        db.close()
+
+
+def has_unsynced_files() -> bool:
+    """
+    Check whether any file still needs syncing (cheaper than counting them
+    when Airflow only decides whether to run the sync).
+    
+    Returns:
+        True if at least one file is unsynced
+    """
+    db = Database()
+    try:
+        with db.acquire_readonly() as conn:
+            return bool(conn.execute(_SQL_HAS_UNSYNCED_FILES).fetchone()[0])
+    finally:
+        db.close()
 
 
 if __name__ == "__main__":
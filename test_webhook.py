@@ -4,16 +4,94 @@ Test script to simulate multiple REDCap webhook calls.
 This script sends test patient data to the webhook endpoint.
 """
 
-import requests
-import json
+import io
+import orjson
 import time
 import sys
-from typing import Dict, List, Tuple
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
+
+# requests is imported on first use, so tooling that imports this module
+# only for TEST_PATIENTS or the helpers doesn't pay for it
+if TYPE_CHECKING:
+    import requests
 
 # Configuration
 WEBHOOK_URL = "http://localhost:8000/redcap/webhook"
+BATCH_WEBHOOK_URL = f"{WEBHOOK_URL}/batch"
 HEALTH_CHECK_URL = "http://localhost:8000/health"
 
+# A successful health check is remembered in HEALTH_CACHE_PATH, so runs
+# started within HEALTH_CACHE_TTL seconds of it skip the check
+HEALTH_CACHE_PATH = Path(tempfile.gettempdir()) / "webhook_health.json"
+HEALTH_CACHE_TTL = 30.0
+
+# Webhook requests in flight at the same time
+DEFAULT_CONCURRENCY = 8
+
+
+def _create_session() -> "requests.Session":
+    """
+    Build the session shared by all requests to the webhook server.
+    
+    Connections are kept alive and pooled (enough for DEFAULT_CONCURRENCY
+    requests at once), so each webhook reuses an open socket. GETs are
+    retried briefly on connection errors; POSTs are never replayed.
+    """
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+    
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=16,
+        pool_maxsize=16,
+        max_retries=Retry(total=2, backoff_factor=0.1)
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers.update({"Content-Type": "application/json", "Connection": "keep-alive"})
+    return session
+
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def _get_session() -> "requests.Session":
+    """Return the shared session, creating it on first use"""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = _create_session()
+    return _session
+
+
+class RateLimiter:
+    """
+    Spaces calls at least `interval` seconds apart across threads.
+    
+    Each call reserves the next free slot and only sleeps if that slot is
+    still ahead, so time spent waiting on responses counts toward the gap.
+    """
+    
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._next_slot = time.monotonic()
+        self._lock = threading.Lock()
+    
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
 # Test data - simulating different CHU centers and patients
 TEST_PATIENTS = [
     {
@@ -60,15 +138,77 @@ TEST_PATIENTS = [
     }
 ]
 
+# TEST_PATIENTS with their JSON request bodies, serialized once at import
+TEST_PATIENTS_ENCODED = tuple((patient, orjson.dumps(patient)) for patient in TEST_PATIENTS)
+
+
+class ResponseFixtures:
+    """
+    Successful webhook responses recorded per patient in a JSON file.
+    
+    Responses are keyed by the patient's JSON with sorted keys, so a
+    replayed run only reuses a response for exactly the same payload.
+    """
+    
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        try:
+            self._responses = orjson.loads(self.path.read_bytes())
+        except FileNotFoundError:
+            self._responses = {}
+    
+    @staticmethod
+    def _key(patient: Dict) -> str:
+        return orjson.dumps(patient, option=orjson.OPT_SORT_KEYS).decode()
+    
+    def get(self, patient: Dict) -> Optional[Dict]:
+        return self._responses.get(self._key(patient))
+    
+    def add(self, patient: Dict, response_data: Dict):
+        self._responses[self._key(patient)] = response_data
+    
+    def save(self):
+        self.path.write_bytes(orjson.dumps(self._responses, option=orjson.OPT_INDENT_2))
+
 
-def check_server_health() -> bool:
-    """Check if the webhook server is running and healthy."""
+def _cached_health_age(cache_ttl: float) -> Optional[float]:
+    """Seconds since the last successful health check of HEALTH_CHECK_URL, if within cache_ttl"""
     try:
-        response = requests.get(HEALTH_CHECK_URL, timeout=5)
+        entry = orjson.loads(HEALTH_CACHE_PATH.read_bytes())
+    except (OSError, orjson.JSONDecodeError):
+        return None
+    if not isinstance(entry, dict) or entry.get("url") != HEALTH_CHECK_URL:
+        return None
+    age = time.time() - entry.get("checked_at", 0)
+    return age if 0 <= age < cache_ttl else None
+
+
+def check_server_health(cache_ttl: float = HEALTH_CACHE_TTL) -> bool:
+    """
+    Check if the webhook server is running and healthy.
+    
+    Args:
+        cache_ttl: Trust a successful check from the last `cache_ttl`
+            seconds instead of asking the server again; 0 always asks
+    """
+    if cache_ttl > 0:
+        age = _cached_health_age(cache_ttl)
+        if age is not None:
+            print(f"✅ Server was healthy {age:.0f}s ago (cached)")
+            return True
+    
+    import requests
+    
+    try:
+        response = _get_session().get(HEALTH_CHECK_URL, timeout=5)
         if response.status_code == 200:
-            data = response.json()
+            data = orjson.loads(response.content)
             print(f"✅ Server is healthy: {data.get('status')}")
             print(f"   Girder connection: {data.get('girder_connection')}")
+            try:
+                HEALTH_CACHE_PATH.write_bytes(orjson.dumps({"url": HEALTH_CHECK_URL, "checked_at": time.time()}))
+            except OSError:
+                pass  # Not caching only costs the next run a request
             return True
         else:
             print(f"⚠️  Server returned status {response.status_code}")
@@ -81,105 +221,204 @@ def check_server_health() -> bool:
         return False
 
 
-def send_webhook(patient_data: Dict) -> Tuple[bool, Dict]:
+def send_webhook(patient_data: Dict, body: Optional[bytes] = None) -> Tuple[bool, Dict]:
     """
     Send a single webhook request with patient data.
     
+    Args:
+        patient_data: Patient fields
+        body: patient_data already serialized to JSON, if available
+    
     Returns:
         (success: bool, response_data: dict)
     """
+    import requests
+    
     try:
-        response = requests.post(
+        response = _get_session().post(
             WEBHOOK_URL,
-            json=patient_data,
-            headers={"Content-Type": "application/json"},
+            data=body if body is not None else orjson.dumps(patient_data),
             timeout=10
         )
         
         if response.status_code == 200:
-            return True, response.json()
+            return True, orjson.loads(response.content)
         else:
-            return False, response.json()
-    except requests.exceptions.RequestException as e:
+            return False, orjson.loads(response.content)
+    except (requests.exceptions.RequestException, orjson.JSONDecodeError) as e:
         return False, {"error": str(e)}
 
 
-def run_tests(delay: float = 1.0, verbose: bool = True):
+def send_webhook_batch(patients: List[Dict]) -> List[Tuple[bool, Dict]]:
+    """
+    Send many patients in a single request to the batch webhook endpoint.
+    
+    Returns:
+        (success: bool, response_data: dict) per patient, in the order of `patients`
+    """
+    import requests
+    
+    try:
+        response = _get_session().post(
+            BATCH_WEBHOOK_URL,
+            data=orjson.dumps({"patients": patients}),
+            timeout=60
+        )
+        response_data = orjson.loads(response.content)
+    except (requests.exceptions.RequestException, orjson.JSONDecodeError) as e:
+        return [(False, {"error": str(e)})] * len(patients)
+    
+    if response.status_code != 200:
+        return [(False, response_data)] * len(patients)
+    
+    # The server reports synced and failed patients separately
+    outcomes = {}
+    for synced in response_data.get("synced_patients") or []:
+        outcomes[(synced["center_code"], synced["patient_id"])] = (True, synced)
+    for failed in response_data.get("failed_patients") or []:
+        outcomes[(failed["center_code"], failed["patient_id"])] = (False, failed)
+    return [
+        outcomes.get((patient["center_code"], patient["patient_id"]),
+                     (False, {"error": "Missing from batch response"}))
+        for patient in patients
+    ]
+
+
+def run_tests(delay: float = 0.0, verbose: bool = True, concurrency: int = DEFAULT_CONCURRENCY,
+              legacy: bool = False, rate: Optional[float] = None,
+              health_cache_ttl: float = HEALTH_CACHE_TTL,
+              fixtures: Optional[ResponseFixtures] = None, record: bool = False):
     """
     Run test suite by sending all test patient data.
     
+    All patients are sent in one request to the batch endpoint. With
+    `legacy`, each patient is sent to the single-patient endpoint instead,
+    from a thread pool so that up to `concurrency` requests are in flight
+    at once. Results are printed in the order of TEST_PATIENTS.
+    
+    With `fixtures`, patients with a recorded response are answered from
+    it without contacting the server, and only the rest are sent. With
+    `record` as well, every patient is sent and successful responses are
+    saved to `fixtures` instead.
+    
     Args:
-        delay: Delay between requests in seconds
+        delay: Minimum delay between the starts of legacy requests in seconds
         verbose: Print detailed information
+        concurrency: Maximum number of legacy requests in flight
+        legacy: Send one request per patient
+        rate: Maximum legacy requests per second, if any
+        health_cache_ttl: Age in seconds up to which a cached health check is trusted
+        fixtures: Recorded responses to replay, or to record into
+        record: Send every patient and record the responses in `fixtures`
     """
     print("=" * 60)
     print("REDCap Webhook Test Suite")
     print("=" * 60)
     print()
     
-    # Check server health first
-    if not check_server_health():
-        print("\n❌ Server health check failed. Exiting.")
-        sys.exit(1)
+    responses = [None] * len(TEST_PATIENTS)
+    if fixtures is not None and not record:
+        for i, patient in enumerate(TEST_PATIENTS):
+            response_data = fixtures.get(patient)
+            if response_data is not None:
+                responses[i] = (True, response_data)
+    pending = [i for i, response in enumerate(responses) if response is None]
     
-    print()
-    print(f"Sending {len(TEST_PATIENTS)} test patient records...")
+    if len(pending) < len(TEST_PATIENTS):
+        print(f"Replaying {len(TEST_PATIENTS) - len(pending)} recorded responses from {fixtures.path}")
+    
+    if pending:
+        # Check server health first
+        if not check_server_health(health_cache_ttl):
+            print("\n❌ Server health check failed. Exiting.")
+            sys.exit(1)
+        
+        print()
+        if legacy:
+            print(f"Sending {len(pending)} test patient records...")
+        else:
+            print(f"Sending {len(pending)} test patient records in one batch request...")
     print("-" * 60)
     
     results = {
         "success": 0,
         "failed": 0,
-        "details": []
+        "details": [None] * len(TEST_PATIENTS)
     }
     
-    for i, patient in enumerate(TEST_PATIENTS, 1):
-        if verbose:
-            print(f"\n[{i}/{len(TEST_PATIENTS)}] Sending: {patient['patient_id']} from {patient['center_code']}...")
+    if pending and legacy:
+        interval = max(delay, 1 / rate if rate else 0.0)
+        limiter = RateLimiter(interval) if interval > 0 else None
         
-        success, response_data = send_webhook(patient)
+        def send_in_turn(patient: Dict, body: bytes) -> Tuple[bool, Dict]:
+            if limiter:
+                limiter.wait()
+            return send_webhook(patient, body)
+        
+        with ThreadPoolExecutor(max_workers=max(concurrency, 1)) as executor:
+            futures = [executor.submit(send_in_turn, *TEST_PATIENTS_ENCODED[i]) for i in pending]
+            for i, future in zip(pending, futures):
+                responses[i] = future.result()
+    elif pending:
+        for i, response in zip(pending, send_webhook_batch([TEST_PATIENTS[i] for i in pending])):
+            responses[i] = response
+    
+    if record and fixtures is not None:
+        for patient, (success, response_data) in zip(TEST_PATIENTS, responses):
+            if success:
+                fixtures.add(patient, response_data)
+        fixtures.save()
+        print(f"Recorded responses to {fixtures.path}")
+    
+    # The report is written to stdout in one go once all results are in
+    report = io.StringIO()
+    for i, (patient, (success, response_data)) in enumerate(zip(TEST_PATIENTS, responses), 1):
+        if verbose:
+            print(f"\n[{i}/{len(TEST_PATIENTS)}] Sent: {patient['patient_id']} from {patient['center_code']}", file=report)
         
         if success:
             results["success"] += 1
             if verbose:
-                print(f"   ✅ Success: {response_data.get('message', 'Synced')}")
+                print(f"   ✅ Success: {response_data.get('message', 'Synced')}", file=report)
                 if 'folder_structure' in response_data:
                     fs = response_data['folder_structure']
-                    print(f"   📁 CHU Folder: {fs['chu_folder']['name']} (ID: {fs['chu_folder']['id'][:8]}...)")
-                    print(f"   📁 Patient Folder: {fs['patient_folder']['name']} (ID: {fs['patient_folder']['id'][:8]}...)")
+                    print(f"   📁 CHU Folder: {fs['chu_folder']['name']} (ID: {fs['chu_folder']['id'][:8]}...)", file=report)
+                    print(f"   📁 Patient Folder: {fs['patient_folder']['name']} (ID: {fs['patient_folder']['id'][:8]}...)", file=report)
+                elif 'patient_folder_id' in response_data:
+                    print(f"   📁 CHU Folder ID: {response_data['chu_folder_id'][:8]}...", file=report)
+                    print(f"   📁 Patient Folder ID: {response_data['patient_folder_id'][:8]}...", file=report)
         else:
             results["failed"] += 1
             error_msg = response_data.get('detail', response_data.get('error', 'Unknown error'))
             if verbose:
-                print(f"   ❌ Failed: {error_msg}")
+                print(f"   ❌ Failed: {error_msg}", file=report)
         
-        results["details"].append({
+        results["details"][i - 1] = {
             "patient": patient,
             "success": success,
             "response": response_data
-        })
-        
-        # Delay between requests
-        if i < len(TEST_PATIENTS):
-            time.sleep(delay)
+        }
     
     # Print summary
-    print()
-    print("=" * 60)
-    print("Test Summary")
-    print("=" * 60)
-    print(f"Total requests: {len(TEST_PATIENTS)}")
-    print(f"✅ Successful: {results['success']}")
-    print(f"❌ Failed: {results['failed']}")
-    print()
+    print(file=report)
+    print("=" * 60, file=report)
+    print("Test Summary", file=report)
+    print("=" * 60, file=report)
+    print(f"Total requests: {len(TEST_PATIENTS)}", file=report)
+    print(f"✅ Successful: {results['success']}", file=report)
+    print(f"❌ Failed: {results['failed']}", file=report)
+    print(file=report)
     
     if results["failed"] > 0:
-        print("Failed requests:")
+        print("Failed requests:", file=report)
         for detail in results["details"]:
             if not detail["success"]:
                 patient = detail["patient"]
                 error = detail["response"].get('detail', detail["response"].get('error', 'Unknown'))
-                print(f"  - {patient['patient_id']}: {error}")
-        print()
+                print(f"  - {patient['patient_id']}: {error}", file=report)
+        print(file=report)
+    
+    sys.stdout.write(report.getvalue())
     
     return results
 
@@ -200,10 +439,10 @@ def test_single_patient(center_code: str, patient_id: str, age: int, sex: str):
     
     if success:
         print("✅ Success!")
-        print(json.dumps(response, indent=2))
+        print(orjson.dumps(response, option=orjson.OPT_INDENT_2).decode())
     else:
         print("❌ Failed!")
-        print(json.dumps(response, indent=2))
+        print(orjson.dumps(response, option=orjson.OPT_INDENT_2).decode())
     
     return success, response
 
@@ -215,8 +454,46 @@ if __name__ == "__main__":
     parser.add_argument(
         "--delay",
         type=float,
-        default=1.0,
-        help="Delay between requests in seconds (default: 1.0)"
+        default=0.0,
+        help="Minimum delay between request starts with --legacy, in seconds (default: 0)"
+    )
+    parser.add_argument(
+        "--rate",
+        type=float,
+        help="Maximum requests per second with --legacy (default: unlimited)"
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=DEFAULT_CONCURRENCY,
+        help=f"Maximum requests in flight with --legacy (default: {DEFAULT_CONCURRENCY})"
+    )
+    parser.add_argument(
+        "--health-ttl",
+        type=float,
+        default=HEALTH_CACHE_TTL,
+        help=f"Reuse a successful health check this many seconds old (default: {HEALTH_CACHE_TTL:g})"
+    )
+    parser.add_argument(
+        "--no-health-cache",
+        action="store_true",
+        help="Always check the server's health before sending"
+    )
+    parser.add_argument(
+        "--legacy",
+        action="store_true",
+        help="Send one request per patient instead of a single batch request"
+    )
+    fixtures_group = parser.add_mutually_exclusive_group()
+    fixtures_group.add_argument(
+        "--replay",
+        metavar="FIXTURES",
+        help="Answer patients from responses recorded in FIXTURES, sending only the others"
+    )
+    fixtures_group.add_argument(
+        "--record",
+        metavar="FIXTURES",
+        help="Send every patient and record successful responses in FIXTURES"
     )
     parser.add_argument(
         "--quiet",
@@ -231,10 +508,14 @@ if __name__ == "__main__":
     )
     
     args = parser.parse_args()
+    fixtures_path = args.record or args.replay
     
     if args.single:
         center, patient_id, age, sex = args.single
         test_single_patient(center, patient_id, int(age), sex)
     else:
-        run_tests(delay=args.delay, verbose=not args.quiet)
+        run_tests(delay=args.delay, verbose=not args.quiet, concurrency=args.concurrency, legacy=args.legacy,
+                  rate=args.rate, health_cache_ttl=0 if args.no_health_cache else args.health_ttl,
+                  fixtures=ResponseFixtures(fixtures_path) if fixtures_path else None,
+                  record=bool(args.record))
 